@@ -0,0 +1,99 @@
+import argparse
+import os
+import sys
+
+from helper import events, harmonize
+
+DEFAULT_EVENTS_DIR = 'data/weather_data/events/'
+
+DESCRIPTION = '''Screen the full record of the product stores for extreme multi-day (atmospheric river) precipitation events.
+                Basin mean precipitation and moisture flux series are computed once per store and cached, events are ranked into an index table,
+                and per event slices of every store are written on demand for analysis.'''
+
+def addArguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--stores',
+                        type=str,
+                        nargs='+',
+                        required=True,
+                        help='Zarr stores written by the downloaders, as path or name=path (e.g. wrf_era5=...zarr). The product is taken from the store name')
+    parser.add_argument('--indexStore',
+                        type=str,
+                        help='Name of the store events are detected on. Defaults to the first store')
+    parser.add_argument('--windowDays',
+                        default=3,
+                        type=int,
+                        help='Length of the events in days, they are ranked on precipitation totals over this window. Defaults to 3')
+    parser.add_argument('--separationDays',
+                        default=7,
+                        type=int,
+                        help='Minimum number of days between two events, so one storm is not counted several times. Defaults to 7')
+    parser.add_argument('--top',
+                        default=20,
+                        type=int,
+                        help='Number of events to keep. Defaults to 20')
+    parser.add_argument('--quantile',
+                        type=float,
+                        help='Only keep events whose total is above this quantile of all window totals e.g. 0.99')
+    parser.add_argument('--materialize',
+                        default='',
+                        type=str,
+                        help='Comma seperated string of event ranks (or all) to write per event slices of every store for')
+    parser.add_argument('--padDays',
+                        default=2,
+                        type=int,
+                        help='Days added on both sides of an event when it is materialized. Defaults to 2')
+    parser.add_argument('--eventsDir',
+                        default=DEFAULT_EVENTS_DIR,
+                        type=str,
+                        help='Directory the series cache, event index (events.csv) and event slices are written to')
+
+def setupArgs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    addArguments(parser)
+    return parser.parse_args()
+
+def parseRanks(paramString: str, table) -> list[int]:
+    if paramString.strip() == 'all':
+        return list(table['rank'])
+    return [int(rank) for rank in paramString.split(',') if rank.strip()]
+
+def main(args: argparse.Namespace) -> None:
+    stores = harmonize.parseStores(args.stores)
+    if len(stores) == 0:
+        print('No usable stores provided. Exiting...')
+        sys.exit(0)
+    index_store = args.indexStore or next(iter(stores))
+    if index_store not in stores:
+        print(f'{index_store} is not one of the stores: {", ".join(stores)}. Exiting...')
+        sys.exit(0)
+
+    series_dir = os.path.join(args.eventsDir, 'series')
+    series = {}
+    for name, (product, path) in stores.items():
+        ds = events.basinSeries(path, product, series_dir)
+        if ds is None or 'precipitation' not in ds:
+            print(f'No daily precipitation series for {name}, leaving it out...')
+            continue
+        series[name] = ds
+    if index_store not in series:
+        print(f'Cannot detect events on {index_store} without a precipitation series. Exiting...')
+        sys.exit(0)
+
+    table = events.detectEvents(series[index_store], args.windowDays, args.separationDays, args.top, args.quantile)
+    if len(table) == 0:
+        print('No events found. Exiting...')
+        sys.exit(0)
+    table.insert(1, 'index_store', index_store)
+    table = events.addProductTotals(table, series)
+    print(f'Event index written to {events.writeEvents(table, args.eventsDir)}')
+    print(table[['rank', 'start', 'end', 'precipitation', 'known']].to_string(index=False))
+
+    ranks = parseRanks(args.materialize, table)
+    for event in table[table['rank'].isin(ranks)].itertuples():
+        for name, (product, path) in stores.items():
+            ds = events.eventSlice(args.eventsDir, event, name, path, args.padDays)
+            if ds is not None:
+                print(f'Event {event.rank} {name}: {events.eventPath(args.eventsDir, event, name)}')
+
+if __name__ == '__main__':
+    main(setupArgs())
@@ -0,0 +1,44 @@
+import argparse
+
+from helper import derived, packing
+
+DESCRIPTION = '''Add or refresh derived variables (wind speed/direction, relative humidity, VPD, Celsius temperature, tmean, total precipitation)
+                in zarr stores that were written without --derived, or after some of their inputs changed.
+                Only the missing derived variables, the ones depending on --changed and time steps appended since the last run are computed and written.'''
+
+def addArguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--stores',
+                        type=str,
+                        nargs='+',
+                        required=True,
+                        help='Zarr stores written by the downloaders')
+    parser.add_argument('--product',
+                        type=str,
+                        required=True,
+                        choices=list(derived.DERIVED_VARIABLES),
+                        help='Product the stores hold, selects the derived variables that apply')
+    parser.add_argument('--changed',
+                        type=str,
+                        default='',
+                        help='Comma seperated string of raw variables that were rewritten, derived variables depending on them are recomputed. Appended time steps are picked up without it')
+    parser.add_argument('--pack',
+                        action='store_true',
+                        help='Pack the derived variables with the default packing for the product, like the downloaders --pack')
+
+def setupArgs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    addArguments(parser)
+    return parser.parse_args()
+
+def parseVariables(paramString: str) -> list[str]:
+    return [var.strip() for var in paramString.split(',') if var.strip()]
+
+def main(args: argparse.Namespace) -> None:
+    changed = parseVariables(args.changed)
+    pack_spec = packing.PACKING_SPECS.get(args.product) if args.pack else None
+    for store in args.stores:
+        names = derived.updateStore(store, args.product, changed, pack_spec)
+        print(f'{store}: {", ".join(names) if names else "derived variables already up to date"}')
+
+if __name__ == '__main__':
+    main(setupArgs())
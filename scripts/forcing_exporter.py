@@ -0,0 +1,78 @@
+import argparse
+import os
+import sys
+import time
+
+from helper import execution, forcing, harmonize, instrumentation, scheduling
+
+DEFAULT_TIME_CHUNK = 2920
+
+DESCRIPTION = '''Export a product store as hydrologic model forcing: VIC 4 daily per cell files (ascii or binary) or DHSVM hourly
+                met files, or one gridded NetCDF per variable. The store is streamed in time blocks, converted to the model units,
+                aggregated to daily or disaggregated to hourly as needed, and the files are appended to in parallel.'''
+
+def addArguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--store',
+                        type=str,
+                        required=True,
+                        help='Zarr store written by the downloaders, the product is taken from the store name')
+    parser.add_argument('--model',
+                        default='vic',
+                        choices=list(forcing.MODELS),
+                        type=str,
+                        help='Model the forcing is written for, sets the time step, columns and units. Defaults to vic')
+    parser.add_argument('--format',
+                        default='ascii',
+                        choices=forcing.FORMATS,
+                        type=str,
+                        help='ascii or binary (VIC only) per cell files, or netcdf for one gridded file per variable. Defaults to ascii')
+    parser.add_argument('--outputDir',
+                        type=str,
+                        required=True,
+                        help='Directory the forcing files, cells.csv (cell lat/lon and file) and forcing_params.txt are written to')
+    parser.add_argument('--startDate',
+                        type=str,
+                        help='First date to export, format YYYY-MM-DD. Defaults to the start of the store')
+    parser.add_argument('--endDate',
+                        type=str,
+                        help='Last date to export (inclusive), format YYYY-MM-DD. Defaults to the end of the store')
+    parser.add_argument('--dayStartHour',
+                        default=8,
+                        type=int,
+                        help='UTC hour days start at when an hourly store is aggregated for a daily model. Defaults to 8 (Pacific midnight)')
+    parser.add_argument('--writers',
+                        type=int,
+                        help='Number of processes formatting and appending to the files. Defaults to the number of cores')
+    parser.add_argument('--cellsPerTask',
+                        default=256,
+                        type=int,
+                        help='Per cell files each writer task appends a block to. Defaults to 256')
+    execution.addExecutionArguments(parser, DEFAULT_TIME_CHUNK)
+    instrumentation.addReportArguments(parser)
+
+def setupArgs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    addArguments(parser)
+    return parser.parse_args()
+
+def main(args: argparse.Namespace) -> None:
+    product = harmonize.productOf(args.store)
+    if product is None:
+        print(f'Could not tell the product of {args.store} from its name. Exiting...')
+        sys.exit(0)
+    if args.format not in forcing.MODELS[args.model]['formats']:
+        print(f'{args.model} forcing can be written as: {", ".join(forcing.MODELS[args.model]["formats"])}. Exiting...')
+        sys.exit(0)
+
+    start = time.perf_counter()
+    with instrumentation.run('forcing', os.path.normpath(args.outputDir), args, args.profile), scheduling.slot('cpu'), \
+            execution.backendFromArgs(args):
+        summary = forcing.export(args.store, product, args.model, args.format, args.outputDir, args.timeChunk, args.writers,
+                                 args.startDate, args.endDate, args.dayStartHour, args.cellsPerTask)
+    if summary is None:
+        sys.exit(0)
+    print(f'{summary["cells"]} cells x {summary["steps"]} steps of {", ".join(summary["variables"])} written to {summary["files"]} files '
+          f'in {args.outputDir} ({summary["bytes"] / 1e6:.0f} MB in {time.perf_counter() - start:.1f} seconds)')
+
+if __name__ == '__main__':
+    main(setupArgs())
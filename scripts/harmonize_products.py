@@ -0,0 +1,106 @@
+import argparse
+import os
+import sys
+
+from helper import execution, harmonize, instrumentation
+
+DEFAULT_OUTPUT_DIR = 'data/weather_data/'
+DEFAULT_SITES = 'data/GIS/skagit_snotel_points.json'
+DEFAULT_CACHE_DIR = 'data/weather_data/points_cache/'
+DEFAULT_TIME_CHUNK = 24 * 365
+
+DESCRIPTION = '''Resample the product stores (HRRR, WRF, PNNL, PRISM, ORNL, SNOTEL) onto a shared UTC hourly and/or daily time axis,
+                with canonical variable names/units and per variable aggregation (sum, mean, min, max), and write one store with a product dimension.'''
+
+def addArguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--stores',
+                        type=str,
+                        nargs='+',
+                        required=True,
+                        help='Zarr stores written by the downloaders, as path or name=path (e.g. wrf_era5=...zarr). The product is taken from the store name, the name defaults to it')
+    parser.add_argument('--frequency',
+                        default='daily',
+                        choices=list(harmonize.FREQUENCIES) + ['both'],
+                        type=str,
+                        help='Shared time axis to build: hourly (only sub-daily products), daily, or both. Defaults to daily')
+    parser.add_argument('--spatial',
+                        default='basin',
+                        choices=harmonize.SPATIAL_MODES,
+                        type=str,
+                        help='basin: basin mean series per product, sites: series at the SNOTEL sites (via the point extractor cache). Defaults to basin')
+    parser.add_argument('--dayStartHour',
+                        default=0,
+                        type=int,
+                        help='UTC hour the daily bins start at, e.g. 12 to match PRISM days. Defaults to 0')
+    parser.add_argument('--startDate',
+                        type=str,
+                        required=True,
+                        help='Start date for the shared axis, format YYYY-MM-DD')
+    parser.add_argument('--endDate',
+                        type=str,
+                        required=True,
+                        help='End date for the shared axis (inclusive), format YYYY-MM-DD')
+    parser.add_argument('--sites',
+                        default=DEFAULT_SITES,
+                        type=str,
+                        help='With --spatial sites, SNOTEL zarr store or GeoJSON of points, like the points subcommand')
+    parser.add_argument('--method',
+                        default='nearest',
+                        choices=['nearest', 'bilinear'],
+                        type=str,
+                        help='With --spatial sites, how values are taken at the sites. Defaults to nearest')
+    parser.add_argument('--cacheDir',
+                        default=DEFAULT_CACHE_DIR,
+                        type=str,
+                        help='With --spatial sites, directory the extracted site series are cached in')
+    parser.add_argument('--outputDir',
+                        default=DEFAULT_OUTPUT_DIR,
+                        type=str,
+                        help='Directory/path to output the harmonized zarr to.')
+    execution.addExecutionArguments(parser, DEFAULT_TIME_CHUNK)
+    instrumentation.addReportArguments(parser)
+
+def setupArgs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    addArguments(parser)
+    return parser.parse_args()
+
+def harmonizedPath(output_dir: str, start: str, end: str, frequency: str, spatial: str) -> str:
+    return os.path.join(output_dir, f'{start}_{end}_harmonized_{frequency}_{spatial}.zarr')
+
+def main(args: argparse.Namespace) -> None:
+    stores = harmonize.parseStores(args.stores)
+    if len(stores) == 0:
+        print('No usable stores provided. Exiting...')
+        sys.exit(0)
+    sites = None
+    if args.spatial == 'sites':
+        from helper.points import loadSites
+        sites = loadSites(args.sites)
+
+    frequencies = list(harmonize.FREQUENCIES) if args.frequency == 'both' else [args.frequency]
+    for frequency in frequencies:
+        output_file = harmonizedPath(args.outputDir, args.startDate, args.endDate, frequency, args.spatial)
+        with instrumentation.run('harmonize', output_file, args, args.profile):
+            with instrumentation.stage('import'):
+                import xarray  # noqa: F401
+            with execution.backendFromArgs(args):
+                datasets = {}
+                for name, (product, path) in stores.items():
+                    with instrumentation.stage('merge', store=path):
+                        ds = harmonize.harmonizeStore(path, product, frequency, args.spatial, sites, args.cacheDir, args.method, args.dayStartHour)
+                    if ds is None:
+                        print(f'{name} is coarser than {frequency}, leaving it out of the {frequency} store')
+                        continue
+                    datasets[name] = ds
+                if len(datasets) == 0:
+                    print(f'No stores fit the {frequency} axis, skipping...')
+                    continue
+
+                combined = harmonize.combine(datasets, args.timeChunk).sel(time=slice(args.startDate, args.endDate))
+                with instrumentation.stage('write', scheduler=args.scheduler):
+                    combined.to_zarr(output_file, mode='w')
+            print(f'{output_file}: {", ".join(combined.data_vars)} for {", ".join(datasets)}')
+
+if __name__ == '__main__':
+    main(setupArgs())
@@ -0,0 +1,191 @@
+# Derived variables computed once at ingest and stored next to the raw ones, instead of being redone by hand
+# in every notebook session. numpy/xarray are imported where they're used, the downloaders load this before
+# argument parsing.
+#
+# Each kernel takes and returns plain numpy arrays and is run chunk by chunk with xr.apply_ufunc, so it stays
+# lazy and parallel under the dask backend from helper.execution.
+
+def kelvinToCelsius(t):
+    return t - 273.15
+
+def fahrenheitToCelsius(t):
+    return (t - 32) * (5 / 9)
+
+def mean(a, b):
+    return (a + b) / 2
+
+def total(a, b):
+    return a + b
+
+def windSpeed(u, v):
+    import numpy as np
+    return np.hypot(u, v)
+
+def windDirection(u, v):
+    import numpy as np
+    # Meteorological convention, degrees the wind blows from. WRF U10/V10 are grid relative, on the
+    # Lambert grid over the basin that rotation is a few degrees at most
+    return np.mod(270 - np.degrees(np.arctan2(v, u)), 360)
+
+def saturationVaporPressure(t_celsius):
+    import numpy as np
+    # Bolton (1980), Pa
+    return 611.2 * np.exp(17.67 * t_celsius / (t_celsius + 243.5))
+
+def relativeHumidity(w, t, p):
+    import numpy as np
+    # From water vapor mixing ratio (kg/kg, WRF Q2), temperature (K) and pressure (Pa), in percent
+    vapor_pressure = w * p / (0.622 + w)
+    return np.clip(100 * vapor_pressure / saturationVaporPressure(t - 273.15), 0, 100)
+
+def vaporPressureDeficit(t, rh):
+    # From temperature (K) and relative humidity (%), in hPa to match PRISM's vpd
+    return saturationVaporPressure(t - 273.15) * (1 - rh / 100) / 100
+
+# Per product: derived name -> inputs (raw or other derived variables), kernel and attributes
+DERIVED_VARIABLES = {
+    'wrf': {
+        'T2C': {'inputs': ['T2'], 'func': kelvinToCelsius, 'attrs': {'units': 'degC', 'long_name': '2 m temperature'}},
+        'PRCP': {'inputs': ['RAINC', 'RAINNC'], 'func': total, 'attrs': {'units': 'mm', 'long_name': 'Total (convective + non-convective) precipitation, accumulated since the start of the run'}},
+        'WSPD': {'inputs': ['U10', 'V10'], 'func': windSpeed, 'attrs': {'units': 'm s-1', 'long_name': '10 m wind speed'}},
+        'WDIR': {'inputs': ['U10', 'V10'], 'func': windDirection, 'attrs': {'units': 'degree', 'long_name': '10 m wind direction (from)'}},
+        'RH2': {'inputs': ['Q2', 'T2', 'PSFC'], 'func': relativeHumidity, 'attrs': {'units': '%', 'long_name': '2 m relative humidity'}},
+        'VPD': {'inputs': ['T2', 'RH2'], 'func': vaporPressureDeficit, 'attrs': {'units': 'hPa', 'long_name': '2 m vapor pressure deficit'}},
+    },
+    'pnnl': {
+        'T2C': {'inputs': ['T2'], 'func': kelvinToCelsius, 'attrs': {'units': 'degC', 'long_name': '2 m temperature'}},
+        'WSPD': {'inputs': ['U10', 'V10'], 'func': windSpeed, 'attrs': {'units': 'm s-1', 'long_name': '10 m wind speed'}},
+        'WDIR': {'inputs': ['U10', 'V10'], 'func': windDirection, 'attrs': {'units': 'degree', 'long_name': '10 m wind direction (from)'}},
+    },
+    'hrrr': {
+        'T2C': {'inputs': ['t2m'], 'func': kelvinToCelsius, 'attrs': {'units': 'degC', 'long_name': '2 m temperature'}},
+        'TSC': {'inputs': ['t'], 'func': kelvinToCelsius, 'attrs': {'units': 'degC', 'long_name': 'Surface temperature'}},
+        'WSPD': {'inputs': ['u10', 'v10'], 'func': windSpeed, 'attrs': {'units': 'm s-1', 'long_name': '10 m wind speed'}},
+        'WDIR': {'inputs': ['u10', 'v10'], 'func': windDirection, 'attrs': {'units': 'degree', 'long_name': '10 m wind direction (from)'}},
+        'VPD': {'inputs': ['t2m', 'r2'], 'func': vaporPressureDeficit, 'attrs': {'units': 'hPa', 'long_name': '2 m vapor pressure deficit'}},
+    },
+    'prism': {
+        'vpd': {'inputs': ['vpdmax', 'vpdmin'], 'func': mean, 'attrs': {'units': 'hPa', 'long_name': 'Mean daily vapor pressure deficit'}},
+    },
+    'ornl': {
+        'tmean': {'inputs': ['tmax', 'tmin'], 'func': mean, 'attrs': {'units': 'degC', 'long_name': 'Mean daily temperature'}},
+    },
+    'snotel': {
+        'T2C': {'inputs': ['AIR TEMP'], 'func': fahrenheitToCelsius, 'attrs': {'units': 'degC', 'long_name': 'Air temperature'}},
+        'AVG_T2C': {'inputs': ['AVG AIR TEMP'], 'func': fahrenheitToCelsius, 'attrs': {'units': 'degC', 'long_name': 'Average air temperature'}},
+        'MAX_T2C': {'inputs': ['MAX AIR TEMP'], 'func': fahrenheitToCelsius, 'attrs': {'units': 'degC', 'long_name': 'Maximum air temperature'}},
+    },
+}
+
+def addDerivedArguments(parser) -> None:
+    parser.add_argument('--derived',
+                        action='store_true',
+                        help='Compute derived variables (e.g. wind speed/direction, relative humidity, Celsius temperature) and store them alongside the raw ones')
+
+def dependencyOrder(product: str) -> list[str]:
+    '''Derived variables of product ordered so each comes after any derived variable it depends on'''
+    registry = DERIVED_VARIABLES.get(product, {})
+    ordered = []
+    def visit(name, seen=()):
+        if name in ordered or name not in registry:
+            return
+        if name in seen:
+            raise ValueError(f'Circular dependency in derived variables for {product}: {name}')
+        for dependency in registry[name]['inputs']:
+            visit(dependency, seen + (name,))
+        ordered.append(name)
+    for name in registry:
+        visit(name)
+    return ordered
+
+def affected(product: str, changed: list[str]) -> list[str]:
+    '''Derived variables that need recomputing when the variables in changed are appended/rewritten,
+    following derived variables that depend on other derived variables'''
+    registry = DERIVED_VARIABLES.get(product, {})
+    dirty = set(changed)
+    result = []
+    for name in dependencyOrder(product):
+        if dirty & set(registry[name]['inputs']):
+            dirty.add(name)
+            result.append(name)
+    return result
+
+def compute(ds, product: str, name: str):
+    import numpy as np
+    import xarray as xr
+    spec = DERIVED_VARIABLES[product][name]
+    inputs = [ds[var] for var in spec['inputs']]
+    result = xr.apply_ufunc(spec['func'], *inputs, dask='parallelized', output_dtypes=[np.float32], keep_attrs=False)
+    result = result.astype(np.float32)
+    result.attrs = dict(spec['attrs'], derived_from=','.join(spec['inputs']))
+    return result.rename(name)
+
+def derive(ds, product: str, only: list[str] | None = None):
+    '''Add every derived variable of product whose inputs are in ds (or just those in only)'''
+    for name in dependencyOrder(product):
+        if only is not None and name not in only:
+            continue
+        if all(var in ds.variables for var in DERIVED_VARIABLES[product][name]['inputs']):
+            ds[name] = compute(ds, product, name)
+    return ds
+
+def storedVariable(store: str, name: str):
+    '''One variable of a zarr store opened on its own, since derived variables can lag behind their inputs after an append'''
+    import xarray as xr
+    import zarr
+    others = [var for var in zarr.open_group(store, mode='r').array_keys() if var != name]
+    return xr.open_zarr(store, drop_variables=others)[name]
+
+def appendChunks(start: int, end: int, chunk: int) -> tuple[int, ...]:
+    '''Dask chunks for steps start..end appended to an array with `chunk` sized zarr chunks, the first one filling
+    up the partial last zarr chunk so no two dask chunks write the same zarr chunk'''
+    first = min(chunk - start % chunk, end - start)
+    rest = end - start - first
+    return (first,) + (chunk,) * (rest // chunk) + ((rest % chunk,) if rest % chunk else ())
+
+def updateStore(store: str, product: str, changed: list[str] | None = None, pack_spec: dict | None = None, dim: str = 'time') -> list[str]:
+    '''Bring the derived variables of an existing zarr store up to date. Missing ones are computed in full, the ones
+    depending on changed (raw variables that were rewritten) are recomputed in place, and the time steps appended to
+    the inputs since the others were derived are computed and appended along dim, so the history isn't rewritten'''
+    import xarray as xr
+    import zarr
+    from helper.packing import packingEncoding
+    from helper.scheduling import storeLock
+    stored = set(zarr.open_group(store, mode='r').array_keys())
+    existing = [name for name in dependencyOrder(product) if name in stored]
+    # Inputs only, opening the derived variables alongside them fails once the inputs are longer
+    ds = xr.open_zarr(store, drop_variables=existing)
+    steps = ds.sizes.get(dim)
+    # Derived variables depending on other derived ones get them recomputed lazily in the same graph
+    full = derive(ds.copy(), product)
+    missing = [name for name in dependencyOrder(product) if name not in existing and name in full.data_vars]
+    rewrite = [name for name in affected(product, changed or []) if name in existing]
+
+    # Existing derived variables to update, by how far along dim they were written and their chunk size
+    stale = {}
+    for name in existing:
+        if name not in full.data_vars:
+            continue
+        variable = storedVariable(store, name)
+        written = (variable.sizes[dim], variable.encoding['chunks'][variable.dims.index(dim)]) if steps and dim in variable.dims else (None, None)
+        if name in rewrite or (written[0] is not None and written[0] < steps):
+            stale.setdefault(written, []).append(name)
+
+    with storeLock(store):
+        if missing:
+            update = full[missing].reset_coords(drop=True)
+            update.to_zarr(store, mode='a', encoding=packingEncoding(update, pack_spec or {}))
+        # Variables already in the store keep the encoding and chunks they were created with
+        for (length, chunk), names in stale.items():
+            update = full[names].reset_coords(drop=True)
+            if length is None:
+                update.to_zarr(store, mode='a')
+                continue
+            update = update.drop_vars(dim, errors='ignore')
+            rewritten = [name for name in names if name in rewrite]
+            if rewritten:
+                update[rewritten].isel({dim: slice(0, length)}).chunk({dim: chunk}).to_zarr(store, region={dim: slice(0, length)})
+            if length < steps:
+                # The time coordinate was already extended by the inputs' append
+                update.isel({dim: slice(length, None)}).chunk({dim: appendChunks(length, steps, chunk)}).to_zarr(store, append_dim=dim)
+    return missing + [name for names in stale.values() for name in names]
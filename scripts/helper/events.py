@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from typing import TYPE_CHECKING
+
+from helper import harmonize
+from helper.points import storeVersion
+
+# numpy/pandas/xarray are imported where they're used, so the skagit-met CLI can load this before argument parsing
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Series the events are screened on, basin mean and daily
+SERIES_VARIABLES = ['precipitation', 'moisture_flux']
+
+# Events the analysis notebooks were built around, flagged in the index when a detected event overlaps one
+KNOWN_EVENTS = {
+    'ar_1990': ('1990-11-03', '1990-11-17'),
+    'ar_1995': ('1995-11-22', '1995-12-06'),
+    'ar_2003': ('2003-10-14', '2003-10-28'),
+    'ar_2006': ('2006-10-31', '2006-11-13'),
+    'ar_2011': ('2011-01-01', '2011-02-01'),
+    'ar_2021': ('2021-11-10', '2021-11-17'),
+}
+
+EVENTS_FILE = 'events.csv'
+# Part of the series cache key, bump it when how the series are computed changes so older caches are recomputed
+CACHE_VERSION = 2
+
+def seriesPath(cache_dir: str, store: str) -> str:
+    # Keyed on the store and its contents, so a rewritten or appended store is screened again
+    key = json.dumps({'version': CACHE_VERSION, 'store': os.path.abspath(store), 'contents': storeVersion(store), 'variables': SERIES_VARIABLES})
+    digest = hashlib.sha1(key.encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, f'{os.path.basename(store.rstrip("/"))}.{digest}.series.zarr')
+
+def basinSeries(store: str, product: str, cache_dir: str):
+    '''Daily basin mean precipitation and moisture flux of a store, computed in one pass over it and cached'''
+    import xarray as xr
+    path = seriesPath(cache_dir, store)
+    if os.path.exists(path):
+        return xr.open_zarr(path)
+
+    series = harmonize.harmonizeStore(store, product, 'daily', 'basin', variables=SERIES_VARIABLES)
+    if series is None:
+        return None
+    series.attrs['source'] = store
+    os.makedirs(cache_dir, exist_ok=True)
+    series.chunk({'time': -1}).to_zarr(path, mode='w')
+    return xr.open_zarr(path)
+
+def detectEvents(series, window_days: int = 3, separation_days: int = 7, top: int = 20, quantile: float | None = None) -> pd.DataFrame:
+    '''Rank multi-day precipitation events on a daily basin series.
+
+    Events are the largest window_days precipitation totals, declustered so no two events are closer than
+    separation_days: take the largest total left, drop every window overlapping it (plus the separation),
+    repeat. Stops after top events, or once totals fall under the quantile of all window totals if given.'''
+    import numpy as np
+    import pandas as pd
+    precipitation = series.precipitation.load()
+    totals = precipitation.rolling(time=window_days, min_periods=window_days).sum().to_series().dropna()
+    threshold = totals.quantile(quantile) if quantile is not None else -np.inf
+    flux = series.moisture_flux.load().to_series() if 'moisture_flux' in series else None
+
+    events = []
+    remaining = totals.copy()
+    exclusion = pd.Timedelta(days=window_days - 1 + separation_days)
+    while len(remaining) and len(events) < top:
+        end = remaining.idxmax()
+        total = remaining[end]
+        if total < threshold or total <= 0:
+            break
+        start = end - pd.Timedelta(days=window_days - 1)
+        window = precipitation.sel(time=slice(start, end)).to_series()
+        events.append({
+            'start': start.date(),
+            'end': end.date(),
+            'peak_day': window.idxmax().date(),
+            'precipitation': round(float(total), 2),
+            'peak_precipitation': round(float(window.max()), 2),
+            'moisture_flux': round(float(flux[start:end].max()), 5) if flux is not None else np.nan,
+        })
+        remaining = remaining[(remaining.index < end - exclusion) | (remaining.index > end + exclusion)]
+
+    table = pd.DataFrame(events)
+    if len(table):
+        table.insert(0, 'rank', range(1, len(table) + 1))
+        table['known'] = [knownEvent(row.start, row.end) for row in table.itertuples()]
+    return table
+
+def knownEvent(start, end) -> str:
+    for name, (known_start, known_end) in KNOWN_EVENTS.items():
+        if str(start) <= known_end and str(end) >= known_start:
+            return name
+    return ''
+
+def windowTotal(precipitation, start, end) -> float | None:
+    window = precipitation.sel(time=slice(str(start), str(end)))
+    return round(float(window.sum()), 2) if window.size else None
+
+def addProductTotals(table: pd.DataFrame, series: dict) -> pd.DataFrame:
+    '''Precipitation total of every product over each event window, for a quick cross-product look'''
+    for name, ds in series.items():
+        precipitation = ds.precipitation.load()
+        table[f'precipitation_{name}'] = [windowTotal(precipitation, row.start, row.end) for row in table.itertuples()]
+    return table
+
+def writeEvents(table: pd.DataFrame, events_dir: str) -> str:
+    os.makedirs(events_dir, exist_ok=True)
+    path = os.path.join(events_dir, EVENTS_FILE)
+    table.to_csv(path, index=False)
+    return path
+
+def readEvents(events_dir: str) -> pd.DataFrame:
+    import pandas as pd
+    return pd.read_csv(os.path.join(events_dir, EVENTS_FILE), parse_dates=['start', 'end', 'peak_day'])
+
+def eventPath(events_dir: str, event, name: str) -> str:
+    return os.path.join(events_dir, f'{int(event.rank):03d}_{str(event.start)[:10]}_{str(event.end)[:10]}', f'{name}.zarr')
+
+def eventSlice(events_dir: str, event, name: str, store: str, pad_days: int = 2):
+    '''The store cut to an event window (padded by pad_days on both sides), written once under events_dir
+    and reopened from there afterwards, until the store is rewritten or appended to'''
+    import pandas as pd
+    import xarray as xr
+    path = eventPath(events_dir, event, name)
+    version = json.dumps(storeVersion(store))
+    if os.path.exists(path):
+        cached = xr.open_zarr(path)
+        if cached.attrs.get('source_version') == version:
+            return cached
+
+    start = pd.Timestamp(event.start) - pd.Timedelta(days=pad_days)
+    end = pd.Timestamp(event.end) + pd.Timedelta(days=pad_days + 1) - pd.Timedelta(seconds=1)
+    ds = xr.open_zarr(store).sel(time=slice(start, end))
+    if ds.sizes.get('time', 0) == 0:
+        return None
+    for var in ds.variables:
+        ds[var].encoding.pop('chunks', None)
+        ds[var].encoding.pop('preferred_chunks', None)
+    ds.attrs['source_version'] = version
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    ds.to_zarr(path, mode='w')
+    return xr.open_zarr(path)
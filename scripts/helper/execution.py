@@ -0,0 +1,62 @@
+import tempfile
+from contextlib import contextmanager
+
+SCHEDULERS = ['threads', 'processes', 'distributed']
+DEFAULT_SCHEDULER = 'threads'
+
+def addExecutionArguments(parser, default_time_chunk: int) -> None:
+    parser.add_argument('--scheduler',
+                        default=DEFAULT_SCHEDULER,
+                        choices=SCHEDULERS,
+                        type=str,
+                        help='Dask scheduler used to run the merge/mask/write stages: threads, processes, or a local distributed cluster. Defaults to threads')
+    parser.add_argument('--workers',
+                        type=int,
+                        help='Number of dask workers (threads, processes or cluster workers). Defaults to the number of cores')
+    parser.add_argument('--memoryLimit',
+                        type=str,
+                        help='Memory limit per worker e.g. 4GB. Only enforced by the distributed scheduler, which spills to --spillDir past the limit instead of being killed')
+    parser.add_argument('--spillDir',
+                        type=str,
+                        default=tempfile.gettempdir(),
+                        help='Where distributed workers spill to disk. Defaults to the system temp directory')
+    parser.add_argument('--timeChunk',
+                        type=int,
+                        default=default_time_chunk,
+                        help=f'Number of time steps per dask/zarr chunk. Defaults to {default_time_chunk}')
+
+@contextmanager
+def backend(scheduler: str = DEFAULT_SCHEDULER, workers: int | None = None, memory_limit: str | None = None, spill_dir: str | None = None):
+    '''Run any dask computations inside the block (to_zarr, load, compute) on the chosen scheduler'''
+    import dask
+    if scheduler == 'distributed':
+        from dask.distributed import Client, LocalCluster
+        cluster = LocalCluster(n_workers=workers,
+                               threads_per_worker=1,
+                               memory_limit=memory_limit or 'auto',
+                               local_directory=spill_dir)
+        client = Client(cluster)
+        print(f'Dask dashboard at {client.dashboard_link}')
+        try:
+            yield client
+        finally:
+            client.close()
+            cluster.close()
+    else:
+        with dask.config.set(scheduler=scheduler, num_workers=workers):
+            yield None
+
+def backendFromArgs(args):
+    return backend(args.scheduler, args.workers, args.memoryLimit, args.spillDir)
+
+def timeChunked(ds, time_chunk: int, dim: str = 'time'):
+    '''Lazily rechunk to `time_chunk` steps along `dim` and whole chunks in space,
+    so every variable has the uniform chunks to_zarr needs and writes stream chunk by chunk'''
+    return ds.chunk({d: (time_chunk if d == dim else -1) for d in ds.dims})
+
+def deaccumulate(da, dim: str = 'time'):
+    '''Lazily turn a running total (e.g. WRF RAINC/RAINNC, accumulated since the start of the run) into the amount
+    per step along `dim`. Drops from a bucket or restart reset are clipped to 0, and the first step, which has
+    nothing before it to difference against, is kept as 0 so the time axis and chunks are unchanged'''
+    step = (da - da.shift({dim: 1})).clip(min=0)
+    return step.where(da[dim] != da[dim][0], 0 * da)
@@ -0,0 +1,340 @@
+from __future__ import annotations
+
+import os
+from typing import TYPE_CHECKING
+
+from helper import harmonize
+
+# numpy/pandas/xarray/netCDF4 are imported where they're used, so the skagit-met CLI can load this before argument parsing
+if TYPE_CHECKING:
+    import numpy as np
+
+# Model -> time step of its forcing and the canonical variables (see helper/harmonize.py) in file column order
+MODELS = {
+    # VIC 4 daily forcing: PREC TMAX TMIN WIND
+    'vic': {'frequency': 'daily', 'variables': ['precipitation', 'tmax', 'tmin', 'wind_speed'], 'formats': ['ascii', 'binary', 'netcdf']},
+    # DHSVM met station files: Tair Wind RH Sin Lin Precip
+    'dhsvm': {'frequency': 'hourly', 'variables': ['temperature', 'wind_speed', 'relative_humidity', 'shortwave', 'longwave', 'precipitation'], 'formats': ['ascii', 'netcdf']},
+}
+FORMATS = ['ascii', 'binary', 'netcdf']
+
+# Units a model expects where they differ from the canonical ones: variable -> (units, multiplier)
+MODEL_UNITS = {
+    'dhsvm': {'precipitation': ('m', 0.001)},
+}
+
+# VIC 4 binary forcing columns as fixed point: variable -> (dtype, multiplier). The multipliers go in the
+# FORCE_TYPE lines of the global parameter file, see forcing_params.txt next to the files
+VIC_BINARY = {
+    'precipitation': ('<u2', 40),
+    'tmax': ('<i2', 100),
+    'tmin': ('<i2', 100),
+    'wind_speed': ('<i2', 100),
+}
+VIC_NAMES = {'precipitation': 'PREC', 'tmax': 'TMAX', 'tmin': 'TMIN', 'wind_speed': 'WIND'}
+
+FILE_PREFIX = {'vic': 'data', 'dhsvm': 'met'}
+CELLS_FILE = 'cells.csv'
+
+# Daily -> hourly: local hour of the temperature peak, and the offset of local standard time from UTC
+TMAX_HOUR = 15
+UTC_OFFSET_HOURS = -8
+
+def cellFileName(model: str, lat: float, lon: float) -> str:
+    return f'{FILE_PREFIX[model]}_{lat:.5f}_{lon:.5f}'
+
+def openCells(store: str, product: str, model: str, day_start_hour: int = 0):
+    '''Lazy (time, cell) dataset of the model's forcing variables that the store has, at the store's own time step
+    when it is already fine enough, or aggregated to daily for a daily model. Also returns the gridded store for the
+    NetCDF layout'''
+    import numpy as np
+    import xarray as xr
+    from helper.packing import CELL_DIM, fromCellLayout, spatialDims
+    from helper.points import findLatLon
+    gridded = harmonize.toUtc(fromCellLayout(xr.open_zarr(store)))
+    variables = MODELS[model]['variables']
+    step = harmonize.timeStepHours(gridded)
+    if MODELS[model]['frequency'] == 'hourly' and step == 24:
+        # Daily extremes shape the hourly temperature
+        variables = variables + ['tmax', 'tmin']
+    elif MODELS[model]['frequency'] == 'daily' and step < 24:
+        # The daily extremes come out of the sub-daily temperature
+        variables = variables + ['temperature']
+    # Precipitation comes out per time step: running totals (WRF RAINC/RAINNC) are de-accumulated by canonicalize,
+    # so hourly forcing never carries the accumulation
+    ds = harmonize.canonicalize(gridded, product, variables)
+    ds = ds.assign_coords({name: coord for name, coord in gridded.coords.items() if name != 'time'})
+    if MODELS[model]['frequency'] == 'hourly' and step not in (1, 24):
+        return None, gridded
+
+    lat_name, lon_name = findLatLon(gridded)
+    dims = spatialDims(ds)
+    shape = [ds.sizes[d] for d in dims]
+    # Cells from the store's own first time step, before any resampling can turn a partial first day into NaN:
+    # inside the basin mask and with every forcing variable present. A variable with no data anywhere at that
+    # step (not produced for that hour) says nothing about the mask
+    first = ds.isel(time=0).to_array().transpose('variable', *dims).values
+    present = ~np.isnan(first)
+    produced = present.reshape(len(present), -1).any(axis=1)
+    inside = present.any(axis=0)
+    complete = present[produced].all(axis=0)
+    flat = np.flatnonzero(complete.ravel())
+
+    if MODELS[model]['frequency'] == 'daily' and step < 24:
+        ds = harmonize.resample(ds, 'daily', product, day_start_hour)
+    # Whole chunks in space, so the flattening below is a reshape of each time chunk
+    ds = ds.chunk({d: -1 for d in dims})
+    # 1-D or 2-D lat/lon spread over the grid, then picked out per cell
+    grid = xr.DataArray(complete, dims=dims)
+    lat, lon = [gridded[name].broadcast_like(grid).transpose(*dims).values.ravel()[flat] for name in (lat_name, lon_name)]
+    # Flatten space and keep the basin cells, still lazy and chunked in time only
+    cells = xr.Dataset({
+        name: (('time', CELL_DIM), ds[name].transpose('time', *dims).data.reshape(ds.sizes['time'], -1)[:, flat])
+        for name in ds.data_vars
+    }, coords={'time': ds.time, 'lat': (CELL_DIM, lat), 'lon': (CELL_DIM, lon)})
+    # Grid position of every cell, for scattering blocks back onto the grid
+    cells.attrs.update(grid_dims=dims, grid_positions=list(np.unravel_index(flat, shape)),
+                       incomplete_cells=int(inside.sum() - complete.sum()))
+    return cells, gridded
+
+def toModelUnits(block: dict, model: str) -> dict:
+    for name, (_, multiplier) in MODEL_UNITS.get(model, {}).items():
+        if name in block:
+            block[name] = block[name] * multiplier
+    return block
+
+def solarWeights(times, lat, lon):
+    '''(days, 24, cells) weights from the cosine of the solar zenith angle at each hour, each day summing to 24,
+    used to spread daily mean shortwave over the hours it actually falls in'''
+    import numpy as np
+    days = times.reshape(-1, 24)
+    doy = (days.astype('datetime64[D]') - days.astype('datetime64[Y]')).astype(int)[..., None] + 1
+    utc_hour = (days - days.astype('datetime64[D]')).astype('timedelta64[m]').astype(float)[..., None] / 60
+    declination = np.radians(23.44) * np.sin(2 * np.pi * (284 + doy) / 365)
+    hour_angle = np.radians(15 * (utc_hour + 0.5 + lon / 15 - 12))
+    lat = np.radians(lat)
+    cos_zenith = np.clip(np.sin(lat) * np.sin(declination) + np.cos(lat) * np.cos(declination) * np.cos(hour_angle), 0, None)
+    total = cos_zenith.sum(axis=1, keepdims=True)
+    # Polar night never happens at the basin's latitude, but keep a flat profile rather than divide by zero
+    return np.where(total > 0, 24 * cos_zenith / np.where(total > 0, total, 1), 1.0)
+
+def hourlyTimes(days, product: str):
+    '''Hourly UTC times covering each daily label's day, the 24 hours around the day's midpoint'''
+    import numpy as np
+    start = days + np.timedelta64(harmonize.DAY_MIDPOINT_HOURS.get(product, 12) - 12, 'h')
+    return (start[:, None] + np.arange(24).astype('timedelta64[h]')).ravel()
+
+def disaggregate(block: dict, days, product: str, lat, lon) -> tuple:
+    '''Daily (days, cells) fields to hourly (days * 24, cells): precipitation spread evenly, temperature as a
+    cosine between tmin and tmax peaking at TMAX_HOUR local, shortwave shaped by the sun, the rest held constant.
+    Everything is broadcast over days, hours and cells at once'''
+    import numpy as np
+    times = hourlyTimes(days, product)
+    n_days = len(days)
+    hourly = {}
+    for name, values in block.items():
+        if name in ('tmax', 'tmin'):
+            continue
+        if name == 'precipitation':
+            hourly[name] = np.repeat(values / 24, 24, axis=0)
+        elif name == 'shortwave':
+            hourly[name] = (values[:, None, :] * solarWeights(times, lat, lon)).reshape(n_days * 24, -1)
+        else:
+            hourly[name] = np.repeat(values, 24, axis=0)
+    if 'tmax' in block and 'tmin' in block:
+        local_hour = ((times - times.astype('datetime64[D]')).astype('timedelta64[h]').astype(int) + UTC_OFFSET_HOURS) % 24
+        shape = np.cos(2 * np.pi * (local_hour - TMAX_HOUR) / 24).reshape(n_days, 24, 1)
+        mean = (block['tmax'] + block['tmin'])[:, None, :] / 2
+        amplitude = (block['tmax'] - block['tmin'])[:, None, :] / 2
+        hourly['temperature'] = (mean + amplitude * shape).reshape(n_days * 24, -1)
+    return hourly, times
+
+def readBlock(cells, start: int, stop: int, model: str, product: str, disaggregated: bool) -> tuple:
+    '''One time-major block as {variable: (time, cell) float32 array} in model units, and its times'''
+    import numpy as np
+    block = cells.isel(time=slice(start, stop)).load()
+    values = {name: block[name].values.astype(np.float32) for name in block.data_vars}
+    times = block.time.values
+    if disaggregated:
+        values, times = disaggregate(values, times, product, block.lat.values, block.lon.values)
+    values = toModelUnits(values, model)
+    return {name: values[name].astype(np.float32) for name in MODELS[model]['variables'] if name in values}, times
+
+def timeLabels(times) -> np.ndarray:
+    # DHSVM's MM/DD/YYYY-HH
+    import pandas as pd
+    return pd.DatetimeIndex(times).strftime('%m/%d/%Y-%H').to_numpy(dtype=object)
+
+def writeAscii(paths: list[str], columns: np.ndarray, labels: np.ndarray = None, decimals: int = 4) -> int:
+    '''Append a (time, cell, column) block to one whitespace separated file per cell. Each cell's rows are
+    formatted with a single % over the whole block and written with one append'''
+    import numpy as np
+    n_time, _, n_columns = columns.shape
+    row = ' '.join([f'%.{decimals}f'] * n_columns) + '\n'
+    if labels is not None:
+        row = '%s ' + row
+    text_format = row * n_time
+    written = 0
+    for i, path in enumerate(paths):
+        values = columns[:, i, :]
+        if labels is not None:
+            values = np.column_stack([labels, values.astype(object)])
+        text = text_format % tuple(values.ravel().tolist())
+        with open(path, 'a') as f:
+            f.write(text)
+        written += len(text)
+    return written
+
+def writeBinary(paths: list[str], columns: np.ndarray, dtypes: list[tuple[str, int]]) -> int:
+    '''Append a (time, cell, column) block to one VIC 4 binary forcing file per cell, fixed point records'''
+    import numpy as np
+    record = np.dtype([(f'c{j}', dtype) for j, (dtype, _) in enumerate(dtypes)])
+    packed = np.empty(columns.shape[:2], dtype=record)
+    for j, (dtype, multiplier) in enumerate(dtypes):
+        info = np.iinfo(dtype)
+        packed[f'c{j}'] = np.clip(np.rint(np.nan_to_num(columns[:, :, j]) * multiplier), info.min, info.max)
+    written = 0
+    for i, path in enumerate(paths):
+        data = packed[:, i].tobytes()
+        with open(path, 'ab') as f:
+            f.write(data)
+        written += len(data)
+    return written
+
+def writeNetcdf(path: str, name: str, values: np.ndarray, times, offset: int, grid: dict, units: str) -> int:
+    '''Write a (time, cell) block of one variable into its gridded NetCDF at time index offset, creating the file
+    with an unlimited time dim on the first block'''
+    import netCDF4
+    import numpy as np
+    if offset == 0:
+        with netCDF4.Dataset(path, 'w') as nc:
+            nc.createDimension('time', None)
+            for dim, size in zip(grid['dims'], grid['shape']):
+                nc.createDimension(dim, size)
+            time = nc.createVariable('time', 'f8', ('time',))
+            time.units = 'hours since 1970-01-01 00:00:00'
+            time.calendar = 'standard'
+            time.time_zone = 'UTC'
+            for coord, (dims, coord_values) in grid['coords'].items():
+                nc.createVariable(coord, coord_values.dtype, dims)[:] = coord_values
+            var = nc.createVariable(name, 'f4', ('time', *grid['dims']), zlib=True, complevel=1, fill_value=np.float32(np.nan),
+                                    chunksizes=(min(len(times), 744), *grid['shape']))
+            var.units = units
+            auxiliary = [coord for coord in grid['coords'] if coord not in grid['dims']]
+            if auxiliary:
+                var.coordinates = ' '.join(auxiliary)
+    gridded = np.full((values.shape[0], *grid['shape']), np.nan, dtype=np.float32)
+    gridded[(slice(None), *grid['positions'])] = values
+    with netCDF4.Dataset(path, 'a') as nc:
+        nc['time'][offset:offset + len(times)] = (times - np.datetime64('1970-01-01')) / np.timedelta64(1, 'h')
+        nc[name][offset:offset + len(times)] = gridded
+    return gridded.nbytes
+
+def gridInfo(cells, gridded) -> dict:
+    dims = list(cells.attrs['grid_dims'])
+    coords = {}
+    for name, coord in gridded.coords.items():
+        if name != 'time' and set(coord.dims) <= set(dims):
+            coords[name] = (coord.dims, coord.values)
+    return {
+        'dims': dims,
+        'shape': [gridded.sizes[d] for d in dims],
+        'positions': list(cells.attrs['grid_positions']),
+        'coords': coords,
+    }
+
+def outputUnits(name: str, model: str) -> str:
+    return MODEL_UNITS.get(model, {}).get(name, (harmonize.CANONICAL_VARIABLES[name]['units'],))[0]
+
+def writeManifest(output_dir: str, model: str, file_format: str, variables: list[str], cells, paths: list[str]) -> None:
+    '''cells.csv (cell, lat, lon and file for per cell formats) and, for VIC, the FORCE_TYPE lines describing the columns'''
+    import pandas as pd
+    table = pd.DataFrame({'lat': cells.lat.values, 'lon': cells.lon.values})
+    if file_format != 'netcdf':
+        table['file'] = [os.path.basename(p) for p in paths]
+    table.index.name = 'cell'
+    table.to_csv(os.path.join(output_dir, CELLS_FILE))
+    if model != 'vic' or file_format == 'netcdf':
+        return
+    with open(os.path.join(output_dir, 'forcing_params.txt'), 'w') as f:
+        f.write(f'FORCE_FORMAT {"BINARY" if file_format == "binary" else "ASCII"}\n')
+        f.write(f'N_TYPES {len(variables)}\n')
+        for name in variables:
+            if file_format == 'binary':
+                dtype, multiplier = VIC_BINARY[name]
+                f.write(f'FORCE_TYPE {VIC_NAMES[name]} {"UNSIGNED" if dtype.endswith("u2") else "SIGNED"} {multiplier}\n')
+            else:
+                f.write(f'FORCE_TYPE {VIC_NAMES[name]}\n')
+        f.write('FORCE_DT 24\n')
+
+def export(store: str, product: str, model: str, file_format: str, output_dir: str, time_chunk: int, writers: int | None = None,
+           start_date: str | None = None, end_date: str | None = None, day_start_hour: int = 0, cells_per_task: int = 256) -> dict:
+    '''Stream the store into model forcing files under output_dir, time_chunk steps at a time.
+
+    Each block is read once (all cells, all variables), converted and disaggregated with array kernels, then split
+    across a process pool by cell group (ascii/binary) or variable (netcdf) and appended. The next block is read
+    while the current one is being written, so the export runs at the pace of the slower of the two'''
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, wait
+
+    import numpy as np
+    from helper import instrumentation
+    cells, gridded = openCells(store, product, model, day_start_hour)
+    if cells is None:
+        print(f'{store} is not hourly or daily, cannot build {model} forcing from it')
+        return None
+    if cells.attrs['incomplete_cells']:
+        print(f'{cells.attrs["incomplete_cells"]} cells in the basin are missing some of the forcing variables, they are skipped')
+    cells = cells.sel(time=slice(start_date, end_date))
+    variables = [name for name in MODELS[model]['variables'] if name in cells.data_vars or (name == 'temperature' and 'tmax' in cells.data_vars)]
+    missing = [name for name in MODELS[model]['variables'] if name not in variables]
+    if missing:
+        print(f'{store} has nothing to build {", ".join(missing)} from, those columns are left out')
+    disaggregated = MODELS[model]['frequency'] == 'hourly' and harmonize.timeStepHours(cells) == 24
+    n_steps, n_cells = cells.sizes['time'], cells.sizes['cell']
+
+    os.makedirs(output_dir, exist_ok=True)
+    paths = [os.path.join(output_dir, cellFileName(model, lat, lon)) for lat, lon in zip(cells.lat.values, cells.lon.values)]
+    if file_format == 'netcdf':
+        grid = gridInfo(cells, gridded)
+        paths = [os.path.join(output_dir, f'{name}.nc') for name in variables]
+    # Files are appended to block by block, so start from empty ones
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+    writeManifest(output_dir, model, file_format, variables, cells, paths)
+
+    def submitBlock(executor, block: dict, times, offset: int) -> list:
+        if file_format == 'netcdf':
+            return [executor.submit(writeNetcdf, path, name, block[name], times, offset, grid, outputUnits(name, model))
+                    for name, path in zip(variables, paths)]
+        columns = np.stack([block[name] for name in variables], axis=-1)
+        labels = timeLabels(times) if model == 'dhsvm' else None
+        futures = []
+        for start in range(0, n_cells, cells_per_task):
+            stop = min(start + cells_per_task, n_cells)
+            group = np.ascontiguousarray(columns[:, start:stop])
+            if file_format == 'binary':
+                futures.append(executor.submit(writeBinary, paths[start:stop], group, [VIC_BINARY[name] for name in variables]))
+            else:
+                futures.append(executor.submit(writeAscii, paths[start:stop], group, labels))
+        return futures
+
+    written, offset, pending = 0, 0, []
+    # Spawned rather than forked, forking after zarr/dask have started their threads can deadlock the workers
+    with ProcessPoolExecutor(writers or os.cpu_count(), mp_context=multiprocessing.get_context('spawn')) as executor:
+        for start in range(0, n_steps, time_chunk):
+            with instrumentation.stage('read', start=start):
+                block, times = readBlock(cells, start, min(start + time_chunk, n_steps), model, product, disaggregated)
+            # Appends to a file have to land in order, so the previous block finishes before this one is handed out
+            with instrumentation.stage('write'):
+                done, _ = wait(pending)
+                written += sum(future.result() for future in done)
+            pending = submitBlock(executor, block, times, offset)
+            offset += len(times)
+        with instrumentation.stage('write'):
+            done, _ = wait(pending)
+            written += sum(future.result() for future in done)
+    instrumentation.count('bytes', written)
+    instrumentation.count('files', len(paths))
+    return {'cells': n_cells, 'steps': offset, 'files': len(paths), 'bytes': written, 'variables': variables}
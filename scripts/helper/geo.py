@@ -0,0 +1,27 @@
+def curvilinearWindow(lat, lon, geometry, dims: tuple[str, str] = ('y', 'x'), pad: int = 0) -> dict:
+    '''Smallest (y, x) index box of a curvilinear grid whose cell centers cover geometry, as isel slices.
+
+    lat/lon are 2-D (y, x) arrays like WRF's XLAT/XLONG or HRRR's latitude/longitude. Only cells inside the
+    geometry's bounding box get the point in polygon test, so this stays cheap on a full continental domain.
+    Cropping to the window before masking means everything after (reading, masking, writing) only touches the basin.'''
+    import numpy as np
+    from shapely import vectorized
+    lat = np.asarray(lat)
+    lon = np.asarray(lon)
+    min_lon, min_lat, max_lon, max_lat = geometry.bounds
+    candidates = (lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon)
+    rows, cols = np.nonzero(candidates)
+    inside = vectorized.contains(geometry, lon[rows, cols], lat[rows, cols])
+    rows, cols = rows[inside], cols[inside]
+
+    if len(rows) == 0:
+        # Geometry smaller than a cell, keep the cell nearest its center
+        center = geometry.centroid
+        nearest = np.nanargmin((lat - center.y) ** 2 + ((lon - center.x) * np.cos(np.radians(center.y))) ** 2)
+        rows, cols = np.unravel_index([nearest], lat.shape)
+
+    ny, nx = lat.shape
+    return {
+        dims[0]: slice(max(int(rows.min()) - pad, 0), min(int(rows.max()) + pad + 1, ny)),
+        dims[1]: slice(max(int(cols.min()) - pad, 0), min(int(cols.max()) + pad + 1, nx)),
+    }
@@ -0,0 +1,243 @@
+import os
+import re
+
+from helper import derived
+
+# numpy/pandas/xarray are imported where they're used, this module is loaded before argument parsing
+
+def inchesToMillimeters(x):
+    return x * 25.4
+
+def identity(x):
+    return x
+
+def moistureFlux(q, u, v):
+    # Near surface stand-in for integrated vapor transport, specific humidity times 10 m wind speed
+    return q * derived.windSpeed(u, v)
+
+# Shared names, units and how each variable aggregates in time
+CANONICAL_VARIABLES = {
+    'precipitation': {'units': 'mm', 'how': 'sum'},
+    'temperature': {'units': 'degC', 'how': 'mean'},
+    'tmax': {'units': 'degC', 'how': 'max'},
+    'tmin': {'units': 'degC', 'how': 'min'},
+    'wind_speed': {'units': 'm s-1', 'how': 'mean'},
+    'relative_humidity': {'units': '%', 'how': 'mean'},
+    'vpd': {'units': 'hPa', 'how': 'mean'},
+    'shortwave': {'units': 'W m-2', 'how': 'mean'},
+    'longwave': {'units': 'W m-2', 'how': 'mean'},
+    'swe': {'units': 'mm', 'how': 'mean'},
+    'moisture_flux': {'units': 'kg kg-1 m s-1', 'how': 'mean'},
+}
+
+# Sub-daily temperature also gives the daily extremes
+EXTREMES = {'tmax': 'temperature', 'tmin': 'temperature'}
+
+# Per product: canonical name -> candidate (inputs, kernel) to build it from the store, first match wins so
+# derived variables written with --derived are reused
+PRODUCT_VARIABLES = {
+    'wrf': {
+        'precipitation': [(['PREC_ACC'], identity), (['PRCP'], identity), (['RAINC', 'RAINNC'], derived.total)],
+        'temperature': [(['T2C'], identity), (['T2'], derived.kelvinToCelsius)],
+        'wind_speed': [(['WSPD'], identity), (['U10', 'V10'], derived.windSpeed)],
+        'relative_humidity': [(['RH2'], identity), (['Q2', 'T2', 'PSFC'], derived.relativeHumidity)],
+        'vpd': [(['VPD'], identity)],
+        'shortwave': [(['SWDNB'], identity)],
+        'longwave': [(['LWDNB'], identity)],
+        'moisture_flux': [(['Q2', 'U10', 'V10'], moistureFlux)],
+    },
+    'pnnl': {
+        'precipitation': [(['PREC_ACC_NC'], identity)],
+        'temperature': [(['T2C'], identity), (['T2'], derived.kelvinToCelsius)],
+        'wind_speed': [(['WSPD'], identity), (['U10', 'V10'], derived.windSpeed)],
+        'shortwave': [(['SWDOWN'], identity)],
+        'longwave': [(['GLW'], identity)],
+        'moisture_flux': [(['Q2', 'U10', 'V10'], moistureFlux)],
+    },
+    'hrrr': {
+        'precipitation': [(['tp'], identity)],
+        'temperature': [(['T2C'], identity), (['t2m'], derived.kelvinToCelsius)],
+        'wind_speed': [(['si10'], identity), (['WSPD'], identity)],
+        'relative_humidity': [(['r2'], identity)],
+        'vpd': [(['VPD'], identity)],
+        'shortwave': [(['sdswrf'], identity)],
+        'longwave': [(['sdlwrf'], identity)],
+    },
+    'prism': {
+        'precipitation': [(['ppt'], identity)],
+        'temperature': [(['tmean'], identity)],
+        'tmax': [(['tmax'], identity)],
+        'tmin': [(['tmin'], identity)],
+        'vpd': [(['vpd'], identity), (['vpdmax', 'vpdmin'], derived.mean)],
+    },
+    'ornl': {
+        'precipitation': [(['prcp'], identity)],
+        'temperature': [(['tmean'], identity), (['tmax', 'tmin'], derived.mean)],
+        'tmax': [(['tmax'], identity)],
+        'tmin': [(['tmin'], identity)],
+        'wind_speed': [(['wind'], identity)],
+        'relative_humidity': [(['rhum'], identity)],
+        'shortwave': [(['srad'], identity)],
+        'longwave': [(['lrad'], identity)],
+    },
+    'snotel': {
+        'precipitation': [(['PRECIPITATION'], inchesToMillimeters)],
+        'temperature': [(['T2C'], identity), (['AIR TEMP'], derived.fahrenheitToCelsius), (['AVG_T2C'], identity), (['AVG AIR TEMP'], derived.fahrenheitToCelsius)],
+        'tmax': [(['MAX_T2C'], identity), (['MAX AIR TEMP'], derived.fahrenheitToCelsius)],
+        'swe': [(['SWE'], inchesToMillimeters)],
+    },
+}
+
+# Per product: inputs stored as running totals since the start of the run, de-accumulated to per step amounts
+# before any kernel sees them
+ACCUMULATED_VARIABLES = {
+    'wrf': ['PRCP', 'RAINC', 'RAINNC'],
+}
+
+# Store name patterns from the downloaders' output paths
+PRODUCT_PATTERNS = {
+    'hrrr': r'_HRRR_',
+    'wrf': r'_wrf_',
+    'prism': r'_PRISM_',
+    'ornl': r'_ORNL_',
+    'snotel': r'_SNOTEL_',
+    'pnnl': r'_PNNL_',
+}
+
+# Hours from a daily product's time label to the middle of the day it covers, in UTC. PRISM days end at
+# 12 UTC on the labeled date, ORNL (Daymet) and SNOTEL daily values are local (Pacific) days
+DAY_MIDPOINT_HOURS = {
+    'prism': 0,
+    'ornl': 20,
+    'snotel': 20,
+}
+
+FREQUENCIES = {'hourly': '1h', 'daily': '24h'}
+SPATIAL_MODES = ['basin', 'sites']
+PRODUCT_DIM = 'product'
+
+def productOf(store: str) -> str | None:
+    name = os.path.basename(os.path.normpath(store))
+    for product, pattern in PRODUCT_PATTERNS.items():
+        if re.search(pattern, name):
+            return product
+    return None
+
+def parseStores(stores: list[str]) -> dict[str, tuple[str, str]]:
+    '''name -> (product, path) from path or name=path entries'''
+    parsed = {}
+    for entry in stores:
+        name, path = entry.split('=', 1) if '=' in entry else (None, entry)
+        product = productOf(path)
+        if product is None:
+            print(f'Could not tell the product of {path} from its name. Skipping...')
+            continue
+        name = name or product
+        if name in parsed:
+            print(f'{name} given more than once, name the stores with name=path. Skipping {path}...')
+            continue
+        parsed[name] = (product, path)
+    return parsed
+
+def toUtc(ds, time_dim: str = 'time'):
+    '''Naive UTC datetime64 time axis, whatever the store came with (tz-aware SNOTEL timestamps, cftime, ...)'''
+    import pandas as pd
+    times = pd.DatetimeIndex(pd.to_datetime(ds[time_dim].values, utc=True)).tz_localize(None)
+    ds = ds.assign_coords({time_dim: times})
+    ds[time_dim].attrs['time_zone'] = 'UTC'
+    return ds
+
+def timeStepHours(ds, time_dim: str = 'time') -> float | None:
+    import numpy as np
+    if ds.sizes.get(time_dim, 0) < 2:
+        return None
+    return np.median(np.diff(ds[time_dim].values)) / np.timedelta64(1, 'h')
+
+def canonicalize(ds, product: str, variables: list[str] | None = None):
+    '''Dataset of the canonical variables (or just those in variables) that can be built from ds, with canonical names and units'''
+    import numpy as np
+    import xarray as xr
+    from helper.execution import deaccumulate
+    out = xr.Dataset(coords={name: coord for name, coord in ds.coords.items() if name in ('time', 'site')})
+    accumulated = ACCUMULATED_VARIABLES.get(product, [])
+    for name, candidates in PRODUCT_VARIABLES.get(product, {}).items():
+        if variables is not None and name not in variables:
+            continue
+        for inputs, func in candidates:
+            if all(var in ds.data_vars for var in inputs):
+                # Running totals need the previous step, so they are differenced here rather than in the blockwise kernel
+                arrays = [deaccumulate(ds[var]) if var in accumulated else ds[var] for var in inputs]
+                result = xr.apply_ufunc(func, *arrays, dask='parallelized', output_dtypes=[np.float32])
+                result.attrs = {'units': CANONICAL_VARIABLES[name]['units'], 'source_variables': ','.join(inputs)}
+                out[name] = result.astype(np.float32)
+                break
+    return out
+
+def resample(ds, frequency: str, product: str, day_start_hour: int = 0):
+    '''Aggregate ds onto the shared hourly or daily axis, each variable with its own aggregation.
+    Daily bins start at day_start_hour UTC, daily products are placed in the bin holding the middle of their day.
+    Returns None when the product is too coarse for the frequency'''
+    import pandas as pd
+    import xarray as xr
+    step = timeStepHours(ds)
+    if step is None or step > (1 if frequency == 'hourly' else 24):
+        return None
+
+    daily_source = step == 24
+    if daily_source:
+        ds = ds.assign_coords(time=ds.time + pd.Timedelta(hours=DAY_MIDPOINT_HOURS.get(product, 12)))
+    offset = pd.Timedelta(hours=day_start_hour if frequency == 'daily' else 0)
+
+    resampled = ds.resample(time=FREQUENCIES[frequency], offset=offset)
+    names = list(ds.data_vars)
+    if frequency == 'daily' and not daily_source:
+        names += [name for name, source in EXTREMES.items() if name not in ds.data_vars and source in ds.data_vars]
+    aggregated = {}
+    out = xr.Dataset()
+    for name in names:
+        source = name if name in ds.data_vars else EXTREMES[name]
+        how = CANONICAL_VARIABLES[name]['how']
+        if how not in aggregated:
+            # A bin with no valid values (e.g. a cell outside the basin mask) stays NaN instead of summing to 0
+            aggregated[how] = resampled.sum(min_count=1) if how == 'sum' else getattr(resampled, how)()
+        out[name] = aggregated[how][source]
+        out[name].attrs = dict(ds[source].attrs, aggregation=how)
+    # Label bins by their start hour/date
+    return out.assign_coords(time=out.time.dt.floor(FREQUENCIES[frequency]))
+
+def basinMean(ds, time_dim: str = 'time'):
+    '''Mean over every non-time dim, skipping masked cells. Regular lat/lon grids are weighted by cos(lat)'''
+    import numpy as np
+    dims = [d for d in ds.dims if d != time_dim]
+    if 'lat' in ds.coords and ds.lat.dims == ('lat',):
+        return ds.weighted(np.cos(np.deg2rad(ds.lat)).fillna(0)).mean(dims)
+    return ds.mean(dims)
+
+def harmonizeStore(store: str, product: str, frequency: str, spatial: str, sites: dict | None = None, cache_dir: str | None = None,
+                   method: str = 'nearest', day_start_hour: int = 0, variables: list[str] | None = None):
+    '''One product's store on the shared time axis, as basin means (time) or at the sites (time, site)'''
+    import xarray as xr
+    from helper.packing import fromCellLayout
+    if spatial == 'sites' and product != 'snotel':
+        from helper.points import extractStore
+        ds = extractStore(store, sites, cache_dir, method)
+    else:
+        ds = fromCellLayout(xr.open_zarr(store))
+        if spatial == 'sites':
+            ds = ds.sel(site=[site for site in sites['site'] if site in ds.site.values])
+
+    ds = canonicalize(toUtc(ds), product, variables)
+    ds = resample(ds, frequency, product, day_start_hour)
+    if ds is None or spatial == 'sites':
+        return ds
+    return basinMean(ds)
+
+def combine(datasets: dict, time_chunk: int):
+    '''Stack per-product datasets along a product dim on the union of their time axes, chunked so a read
+    across all products at a time range (or site) is a single chunk'''
+    import xarray as xr
+    from helper.execution import timeChunked
+    names = list(datasets)
+    combined = xr.concat([datasets[name] for name in names], dim=PRODUCT_DIM, join='outer', coords='minimal', compat='override')
+    combined = combined.assign_coords({PRODUCT_DIM: names}).astype('float32')
+    return timeChunked(combined, time_chunk)
@@ -0,0 +1,174 @@
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Stages every downloader reports on, in pipeline order. Other names are allowed, these are just the common ones
+STAGES = ['list', 'download', 'region', 'decode', 'merge', 'mask', 'write', 'cleanup']
+COUNTERS = ['bytes', 'files', 'retries', 'cache_hits', 'failures']
+PROFILERS = ['cprofile', 'pyinstrument']
+REPORT_SUFFIX = '.report.json'
+
+# Set by the skagit-met CLI, how long it took to get from launch to the subcommand and what was imported by then
+_startup = None
+
+class RunReport:
+    '''Collects stage spans, counters and failures for a single downloader run.
+
+    Safe to update from worker threads, since the downloaders count bytes/failures from inside thread pools.
+    '''
+    def __init__(self, product: str | None = None, args: dict | None = None):
+        self.product = product
+        self.args = args or {}
+        self.started_at = datetime.now(timezone.utc)
+        self.start = time.perf_counter()
+        self.stages = []
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.failures = []
+        self.status = 'running'
+        self.error = None
+        self.profile_path = None
+        self._profiler = None
+        self._profiler_kind = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str, **attrs):
+        span = {'name': name, 'start_s': round(time.perf_counter() - self.start, 6), 'duration_s': None, 'attrs': attrs}
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span['error'] = repr(e)
+            raise
+        finally:
+            span['duration_s'] = round(time.perf_counter() - start, 6)
+            with self._lock:
+                self.stages.append(span)
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def failure(self, stage: str, item: str, error: Exception | str) -> None:
+        with self._lock:
+            self.counters['failures'] += 1
+            self.failures.append({'stage': stage, 'item': str(item), 'error': error if isinstance(error, str) else repr(error)})
+
+    def start_profiler(self, kind: str) -> None:
+        if kind == 'cprofile':
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif kind == 'pyinstrument':
+            # Optional dependency, only needed when asked for
+            from pyinstrument import Profiler
+            self._profiler = Profiler()
+            self._profiler.start()
+        else:
+            raise ValueError(f'Profiler must be one of {PROFILERS}, got {kind}')
+        self._profiler_kind = kind
+
+    def stop_profiler(self, store_path: str) -> str:
+        if self._profiler is None:
+            return None
+        if self._profiler_kind == 'cprofile':
+            self._profiler.disable()
+            self.profile_path = store_path + '.prof'
+            self._profiler.dump_stats(self.profile_path)
+        else:
+            self._profiler.stop()
+            self.profile_path = store_path + '.profile.html'
+            with open(self.profile_path, 'w') as f:
+                f.write(self._profiler.output_html())
+        self._profiler = None
+        return self.profile_path
+
+    def stage_totals(self) -> dict:
+        totals = {}
+        for span in self.stages:
+            totals[span['name']] = round(totals.get(span['name'], 0) + span['duration_s'], 6)
+        return totals
+
+    def to_dict(self) -> dict:
+        finished_at = datetime.now(timezone.utc)
+        return {
+            'product': self.product,
+            'status': self.status,
+            'error': self.error,
+            'started_at': self.started_at.isoformat(),
+            'finished_at': finished_at.isoformat(),
+            'duration_s': round(time.perf_counter() - self.start, 6),
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'argv': sys.argv,
+            'args': self.args,
+            'startup': _startup,
+            'stage_totals': self.stage_totals(),
+            'stages': sorted(self.stages, key=lambda s: s['start_s']),
+            'counters': self.counters,
+            'failures': self.failures,
+            'profile': self.profile_path,
+        }
+
+    def write(self, store_path: str) -> str:
+        store_path = store_path.rstrip('/')
+        self.stop_profiler(store_path)
+        report_path = store_path + REPORT_SUFFIX
+        with open(report_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+        return report_path
+
+# Report for the current run. Module level so helpers and download workers can record against it
+# without threading it through every function; a throwaway report is used when nothing has started a run
+_active = RunReport()
+
+def current() -> RunReport:
+    return _active
+
+def stage(name: str, **attrs):
+    return _active.stage(name, **attrs)
+
+def count(name: str, value: int = 1) -> None:
+    _active.count(name, value)
+
+def failure(stage: str, item: str, error: Exception | str) -> None:
+    _active.failure(stage, item, error)
+
+def mark_startup(seconds: float, loaded_modules: list[str]) -> None:
+    global _startup
+    _startup = {'duration_s': round(seconds, 6), 'heavy_modules_loaded': loaded_modules}
+
+def addReportArguments(parser) -> None:
+    parser.add_argument('--profile',
+                        choices=PROFILERS,
+                        type=str,
+                        help='Profile the run with cProfile or pyinstrument (if installed), output is written next to the zarr store')
+
+@contextmanager
+def run(product: str, store_path: str, args=None, profile: str | None = None):
+    '''Start a run report for `product`, and write it as JSON next to `store_path` when the run ends, even if it fails'''
+    global _active
+    _active = RunReport(product, vars(args) if args is not None and hasattr(args, '__dict__') else args)
+    if profile:
+        _active.start_profiler(profile)
+    try:
+        yield _active
+        _active.status = 'ok'
+    except SystemExit as e:
+        _active.status = 'ok' if not e.code else 'failed'
+        raise
+    except BaseException as e:
+        _active.status = 'failed'
+        _active.error = repr(e)
+        raise
+    finally:
+        try:
+            report_path = _active.write(store_path)
+            print(f'Run report written to {report_path}')
+        except OSError as e:
+            print(f'Failed to write run report for {store_path}: {e}')
@@ -1,5 +1,3 @@
-import pandas as pd
-
 GLOBUS_ROOT = 'https://hydrosource2.ornl.gov/files/SWA9505V3'
 DEFAULT_VARIABLES = ['prcp', 'tmax', 'tmin', 'wind', 'rhum', 'srad', 'lrad']
 DEFAULT_REF_SIM = 'DaymetV4'
@@ -32,6 +30,7 @@ REF_START_YEAR = 1980
 REF_END_YEAR = 2099
 
 def generate_file_names(ref_met: str, hydro_model:str, variables:list, start_year: str, end_year: str, gcm: str, climate_scenario:str, downscaling_method:str) -> list:
+    import pandas as pd
     files = []
 
     historical = False
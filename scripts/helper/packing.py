@@ -0,0 +1,174 @@
+import json
+
+# numpy is imported where it's used, this module is loaded by the downloaders before argument parsing
+
+# Per product, per variable packing applied at write time through the zarr/CF encoding.
+# Values are stored as round((value - add_offset) / scale_factor) in dtype, NaN becomes _FillValue.
+# Variables that aren't listed are written as they come.
+TEMPERATURE_K = {'dtype': 'int16', 'scale_factor': 0.01, 'add_offset': 273.15}
+TEMPERATURE_C = {'dtype': 'int16', 'scale_factor': 0.01, 'add_offset': 0.0}
+PRECIPITATION = {'dtype': 'uint16', 'scale_factor': 0.1, 'add_offset': 0.0}
+ACCUMULATED_PRECIPITATION = {'dtype': 'uint32', 'scale_factor': 0.01, 'add_offset': 0.0}
+RADIATION = {'dtype': 'uint16', 'scale_factor': 0.1, 'add_offset': 0.0}
+WIND = {'dtype': 'int16', 'scale_factor': 0.01, 'add_offset': 0.0}
+PERCENT = {'dtype': 'uint16', 'scale_factor': 0.01, 'add_offset': 0.0}
+VAPOR_PRESSURE_DEFICIT = {'dtype': 'uint16', 'scale_factor': 0.01, 'add_offset': 0.0}
+SPECIFIC_HUMIDITY = {'dtype': 'uint16', 'scale_factor': 1e-6, 'add_offset': 0.0}
+SURFACE_PRESSURE = {'dtype': 'uint16', 'scale_factor': 1.0, 'add_offset': 50000.0}
+WIND_DIRECTION = {'dtype': 'uint16', 'scale_factor': 0.01, 'add_offset': 0.0}
+
+PACKING_SPECS = {
+    'hrrr': {
+        't': TEMPERATURE_K,
+        'r2': PERCENT,
+        'si10': WIND,
+        'sdswrf': RADIATION,
+        'sdlwrf': RADIATION,
+        'tp': PRECIPITATION,
+        # Derived, see helper/derived.py
+        'T2C': TEMPERATURE_C,
+        'TSC': TEMPERATURE_C,
+        'WSPD': WIND,
+        'WDIR': WIND_DIRECTION,
+        'VPD': VAPOR_PRESSURE_DEFICIT,
+    },
+    'wrf': {
+        'T2': TEMPERATURE_K,
+        'TSK': TEMPERATURE_K,
+        'Q2': SPECIFIC_HUMIDITY,
+        'PSFC': SURFACE_PRESSURE,
+        'U10': WIND,
+        'V10': WIND,
+        'SWDNB': RADIATION,
+        'SWUPB': RADIATION,
+        'LWDNB': RADIATION,
+        'LWUPB': RADIATION,
+        'RAINC': ACCUMULATED_PRECIPITATION,
+        'RAINNC': ACCUMULATED_PRECIPITATION,
+        'PREC_ACC': PRECIPITATION,
+        # Derived
+        'T2C': TEMPERATURE_C,
+        'PRCP': ACCUMULATED_PRECIPITATION,
+        'WSPD': WIND,
+        'WDIR': WIND_DIRECTION,
+        'RH2': PERCENT,
+        'VPD': VAPOR_PRESSURE_DEFICIT,
+    },
+    'pnnl': {
+        'T2': TEMPERATURE_K,
+        'Q2': SPECIFIC_HUMIDITY,
+        'U10': WIND,
+        'V10': WIND,
+        'SWDOWN': RADIATION,
+        'GLW': RADIATION,
+        'PREC_ACC_NC': PRECIPITATION,
+        # Derived
+        'T2C': TEMPERATURE_C,
+        'WSPD': WIND,
+        'WDIR': WIND_DIRECTION,
+    },
+    'prism': {
+        'ppt': PRECIPITATION,
+        'tmean': TEMPERATURE_C,
+        'tmax': TEMPERATURE_C,
+        'tmin': TEMPERATURE_C,
+        'tdmean': TEMPERATURE_C,
+        'vpdmax': VAPOR_PRESSURE_DEFICIT,
+        'vpdmin': VAPOR_PRESSURE_DEFICIT,
+        'vpd': VAPOR_PRESSURE_DEFICIT,
+    },
+    'ornl': {
+        'prcp': PRECIPITATION,
+        'tmax': TEMPERATURE_C,
+        'tmin': TEMPERATURE_C,
+        'wind': WIND,
+        'rhum': PERCENT,
+        'srad': RADIATION,
+        'lrad': RADIATION,
+        'tmean': TEMPERATURE_C,
+    },
+}
+
+CELL_DIM = 'cell'
+
+def addPackingArguments(parser) -> None:
+    parser.add_argument('--pack',
+                        action='store_true',
+                        help='Pack output variables into small integer dtypes with scale/offset (e.g. temperature as int16 at 0.01 degrees). Off by default since it is lossy')
+    parser.add_argument('--packSpec',
+                        type=str,
+                        help='JSON file of {"variable": {"dtype": ..., "scale_factor": ..., "add_offset": ...}} that overrides/extends the default packing, implies --pack')
+    parser.add_argument('--cellLayout',
+                        action='store_true',
+                        help='Only store cells inside the basin mask, as a 1-D cell dimension with lat/lon lookup coordinates, instead of the full grid')
+
+def specFromArgs(product: str, args) -> dict:
+    '''Packing spec for product, or None when packing wasn't asked for'''
+    if not args.pack and not args.packSpec:
+        return None
+    spec = dict(PACKING_SPECS.get(product, {}))
+    if args.packSpec:
+        with open(args.packSpec) as f:
+            spec.update(json.load(f))
+    return spec
+
+def fillValue(dtype: str) -> int:
+    import numpy as np
+    # Unsigned types keep 0 for real data, so use the top of the range. Signed use the bottom
+    info = np.iinfo(dtype)
+    return info.max if info.min == 0 else info.min
+
+def packingEncoding(ds, spec: dict) -> dict:
+    encoding = {}
+    for var, packing in spec.items():
+        if var not in ds.data_vars:
+            continue
+        encoding[var] = {
+            'dtype': packing['dtype'],
+            'scale_factor': packing['scale_factor'],
+            'add_offset': packing.get('add_offset', 0.0),
+            '_FillValue': packing.get('_FillValue', fillValue(packing['dtype'])),
+        }
+        # Encoding set on the source (e.g. netCDF _FillValue) would clash with the packed one
+        ds[var].encoding = {}
+    return encoding
+
+def spatialDims(ds, time_dim: str = 'time') -> list[str]:
+    return [d for d in ds.dims if d != time_dim]
+
+def toCellLayout(ds, time_dim: str = 'time'):
+    '''Stack the spatial dims into a single cell dim and keep only cells with data (inside the mask).
+    The original dims become 1-D coordinates along cell, so lat/lon (1-D or 2-D) come along as a lookup.'''
+    import numpy as np
+    dims = spatialDims(ds, time_dim)
+    first = ds.isel({time_dim: 0}) if time_dim in ds.dims else ds
+    valid = np.zeros([ds.sizes[d] for d in dims], dtype=bool)
+    for var in ds.data_vars:
+        if set(dims) <= set(first[var].dims):
+            valid |= first[var].notnull().transpose(*dims).values
+
+    stacked = ds.stack({CELL_DIM: dims}).reset_index(CELL_DIM)
+    stacked = stacked.isel({CELL_DIM: np.flatnonzero(valid.ravel())})
+    stacked.attrs['layout'] = CELL_DIM
+    stacked.attrs['grid_dims'] = dims
+    stacked.attrs['grid_shape'] = [ds.sizes[d] for d in dims]
+    if stacked.chunks:
+        stacked = stacked.chunk({CELL_DIM: -1})
+    return stacked
+
+def fromCellLayout(ds):
+    '''Rebuild the gridded layout from a cell layout store, cells outside the mask come back as NaN'''
+    if ds.attrs.get('layout') != CELL_DIM:
+        return ds
+    dims = list(ds.attrs['grid_dims'])
+    gridded = ds.set_index({CELL_DIM: dims}).unstack(CELL_DIM)
+    for attr in ['layout', 'grid_dims', 'grid_shape']:
+        gridded.attrs.pop(attr, None)
+    return gridded
+
+def prepare(ds, spec: dict | None = None, cell_layout: bool = False):
+    '''Apply the optional cell layout and packing spec, returns the dataset and the encoding to pass to to_zarr'''
+    if cell_layout:
+        ds = toCellLayout(ds)
+    encoding = packingEncoding(ds, spec) if spec else {}
+    return ds, encoding
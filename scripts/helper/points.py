@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import glob
+import hashlib
+import json
+import os
+from typing import TYPE_CHECKING
+
+# numpy/scipy/xarray are imported where they're used, so the skagit-met CLI can load this before argument parsing
+if TYPE_CHECKING:
+    import numpy as np
+
+# Coordinate names used for latitude/longitude by each product, checked in order
+LAT_LON_NAMES = [('lat', 'lon'), ('latitude', 'longitude'), ('CLAT', 'CLONG'), ('XLAT', 'XLONG')]
+# Grid elevation in meters, WRF carries hgt from the metadata file, the others need it added (e.g. from a DEM)
+ELEVATION_NAMES = ['hgt', 'HGT', 'elevation']
+# Variables the lapse rate adjustment is applied to
+TEMPERATURE_VARS = ['T2', 'TSK', 't2m', 't', 'tmax', 'tmin', 'tmean', 'tdmean', 'T2C', 'TSC', 'AVG_T2C']
+DEFAULT_LAPSE_RATE = 6.5  # K per km, standard environmental lapse rate
+EARTH_RADIUS_KM = 6371.0
+METHODS = ['nearest', 'bilinear']
+FEET_TO_METERS = 0.3048
+# Part of every cache key, bump it when what a key covers changes so older caches are recomputed
+CACHE_VERSION = 2
+
+def findLatLon(ds) -> tuple[str, str]:
+    for lat, lon in LAT_LON_NAMES:
+        if lat in ds.variables and lon in ds.variables:
+            return lat, lon
+    raise ValueError(f'No latitude/longitude coordinates found, looked for {LAT_LON_NAMES}')
+
+def toCartesian(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    import numpy as np
+    # Unit sphere coordinates so KD-tree distances don't get skewed by longitude convergence
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+class GridIndex:
+    '''KD-tree over the cell centers of a product grid. Works for 1-D lat/lon dims (PRISM, ORNL),
+    2-D curvilinear lat/lon (HRRR, WRF, PNNL) and the 1-D cell layout from helper.packing'''
+    def __init__(self, ds):
+        import numpy as np
+        from scipy.spatial import cKDTree
+        self.lat_name, self.lon_name = findLatLon(ds)
+        lat = ds[self.lat_name]
+        lon = ds[self.lon_name]
+        if lat.ndim == 1 and lon.ndim == 1 and lat.dims != lon.dims:
+            # Rectilinear grid, dims are the coordinates themselves
+            self.dims = [lat.dims[0], lon.dims[0]]
+            self.lat1d = lat.values
+            self.lon1d = lon.values
+            lon2d, lat2d = np.meshgrid(lon.values, lat.values)
+        else:
+            self.dims = list(lat.dims)
+            self.lat1d = self.lon1d = None
+            lat2d = lat.values
+            lon2d = lon.transpose(*self.dims).values
+        self.shape = lat2d.shape
+        self.lat = lat2d.ravel()
+        self.lon = lon2d.ravel()
+        self.tree = cKDTree(toCartesian(self.lat, self.lon))
+
+    @property
+    def rectilinear(self) -> bool:
+        return self.lat1d is not None
+
+    def nearest(self, lat: np.ndarray, lon: np.ndarray, k: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        '''Flat cell indices (site, k) of the k nearest cells and their distance in km'''
+        import numpy as np
+        chord, flat = self.tree.query(toCartesian(np.asarray(lat), np.asarray(lon)), k=k)
+        distance = 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chord / 2, 0, 1))
+        return flat.reshape(len(lat), k), distance.reshape(len(lat), k)
+
+    def bilinear(self, lat: np.ndarray, lon: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        '''Flat cell indices (site, 4) and weights of the surrounding cells. Exact bilinear on rectilinear grids,
+        on curvilinear grids and the cell layout it falls back to inverse distance weights of the 4 nearest cells'''
+        import numpy as np
+        if not self.rectilinear:
+            flat, distance = self.nearest(lat, lon, k=4)
+            weights = 1 / np.maximum(distance, 1e-6)
+            return flat, weights / weights.sum(axis=1, keepdims=True)
+
+        rows, row_frac = _bracket(self.lat1d, np.asarray(lat))
+        cols, col_frac = _bracket(self.lon1d, np.asarray(lon))
+        nx = self.shape[1]
+        flat = np.column_stack([rows * nx + cols, rows * nx + cols + 1, (rows + 1) * nx + cols, (rows + 1) * nx + cols + 1])
+        weights = np.column_stack([(1 - row_frac) * (1 - col_frac), (1 - row_frac) * col_frac, row_frac * (1 - col_frac), row_frac * col_frac])
+        return flat, weights
+
+    def indexers(self, flat: np.ndarray) -> dict:
+        '''Vectorized isel indexers for (site, k) flat indices'''
+        import numpy as np
+        import xarray as xr
+        positions = np.unravel_index(flat, self.shape)
+        return {dim: xr.DataArray(pos, dims=['site', 'neighbor']) for dim, pos in zip(self.dims, positions)}
+
+def _bracket(coord: np.ndarray, values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Lower index and fractional position of values between neighbouring coordinates, handles descending coords (PRISM lat)
+    import numpy as np
+    descending = coord[0] > coord[-1]
+    c = coord[::-1] if descending else coord
+    idx = np.clip(np.searchsorted(c, values) - 1, 0, len(c) - 2)
+    frac = np.clip((values - c[idx]) / (c[idx + 1] - c[idx]), 0, 1)
+    if descending:
+        idx = len(c) - 2 - idx
+        frac = 1 - frac
+    return idx, frac
+
+def loadSites(path: str) -> dict:
+    '''Site ids, names, lat, lon and elevation (m) from a SNOTEL zarr store or a GeoJSON of points
+    like Data/GIS/skagit_snotel_points.json (elevation in feet as the z coordinate)'''
+    import numpy as np
+    if path.endswith('.zarr') or os.path.isdir(path):
+        import xarray as xr
+        ds = xr.open_zarr(path)
+        return {
+            'site': ds.site.values.astype(str),
+            'site_name': ds.site_name.values.astype(str) if 'site_name' in ds.coords else ds.site.values.astype(str),
+            'lat': ds.lat.values.astype(float),
+            'lon': ds.lon.values.astype(float),
+            'elevation_m': ds.elevation_ft.values.astype(float) * FEET_TO_METERS,
+        }
+
+    with open(path) as f:
+        features = json.load(f)['features']
+    coords = [feature['geometry']['coordinates'] for feature in features]
+    return {
+        'site': np.array([feature['properties'].get('id', i) for i, feature in enumerate(features)]).astype(str),
+        'site_name': np.array([feature['properties'].get('name', '') for feature in features]).astype(str),
+        'lat': np.array([c[1] for c in coords], dtype=float),
+        'lon': np.array([c[0] for c in coords], dtype=float),
+        'elevation_m': np.array([c[2] if len(c) > 2 else np.nan for c in coords], dtype=float) * FEET_TO_METERS,
+    }
+
+def findElevation(ds):
+    for name in ELEVATION_NAMES:
+        if name in ds.variables:
+            return ds[name]
+    return None
+
+def extractPoints(ds, sites: dict, method: str = 'nearest', lapse_rate: float | None = None, variables: list[str] | None = None):
+    '''(time, site) series for every site from a gridded dataset, only indexing the cells around the sites.
+
+    With bilinear, masked (NaN) neighbours are dropped and the remaining weights renormalized, so sites near the
+    basin edge still get a value. With a lapse rate (K/km), temperature variables are shifted from the
+    interpolated grid elevation to the site elevation.'''
+    import numpy as np
+    import xarray as xr
+    index = GridIndex(ds)
+    if method == 'nearest':
+        flat, distance = index.nearest(sites['lat'], sites['lon'])
+        weights = np.ones_like(flat, dtype=float)
+    elif method == 'bilinear':
+        flat, weights = index.bilinear(sites['lat'], sites['lon'])
+        distance = index.nearest(sites['lat'], sites['lon'])[1]
+    else:
+        raise ValueError(f'Method must be one of {METHODS}, got {method}')
+
+    if variables:
+        ds = ds[[v for v in variables if v in ds.data_vars]]
+    weights = xr.DataArray(weights, dims=['site', 'neighbor'])
+    # Only these cells are read from the store
+    neighbors = ds.isel(index.indexers(flat))
+
+    def weighted(da):
+        valid = weights.where(da.notnull(), 0)
+        return (da.fillna(0) * valid).sum('neighbor') / valid.sum('neighbor')
+
+    points = xr.Dataset({var: weighted(neighbors[var]) for var in neighbors.data_vars if 'neighbor' in neighbors[var].dims},
+                        attrs={'method': method})
+    points = points.assign_coords(
+        site=('site', sites['site']),
+        site_name=('site', sites['site_name']),
+        lat=('site', sites['lat']),
+        lon=('site', sites['lon']),
+        elevation_m=('site', sites['elevation_m']),
+        grid_distance_km=('site', distance[:, 0]),
+    )
+
+    elevation = findElevation(ds)
+    if elevation is not None:
+        grid_elevation = weighted(elevation.isel(index.indexers(flat)).astype(float))
+        points = points.assign_coords(grid_elevation_m=('site', grid_elevation.values))
+        if lapse_rate is not None:
+            shift = -lapse_rate / 1000 * (points.elevation_m - points.grid_elevation_m)
+            for var in TEMPERATURE_VARS:
+                if var in points.data_vars:
+                    points[var] = points[var] + shift
+            points.attrs['lapse_rate_k_per_km'] = lapse_rate
+    elif lapse_rate is not None:
+        print('No grid elevation (hgt/HGT/elevation) in dataset, skipping lapse rate adjustment')
+
+    return points
+
+def storeVersion(store: str) -> dict:
+    '''What changes when a store is (re)written or appended to, for cache keys. Appends rewrite the consolidated and
+    array metadata but not the root directory, so its mtime isn't enough; the time extent is checked as well'''
+    import xarray as xr
+    metadata = [path for pattern in ['.zmetadata', 'zarr.json', '*/.zarray', '*/zarr.json'] for path in glob.glob(os.path.join(store, pattern))]
+    time = xr.open_zarr(store).indexes.get('time')
+    return {
+        'metadata_mtime': max((os.path.getmtime(path) for path in metadata), default=os.path.getmtime(store)),
+        'time': [str(time[0]), str(time[-1]), len(time)] if time is not None and len(time) else None,
+    }
+
+def cachePath(cache_dir: str, store: str, sites: dict, method: str, lapse_rate: float, variables: list[str]) -> str:
+    # Keyed on everything that changes the result, including the store's contents
+    key = json.dumps({
+        'version': CACHE_VERSION,
+        'store': os.path.abspath(store),
+        'contents': storeVersion(store),
+        'sites': [list(sites['site']), list(sites['lat']), list(sites['lon'])],
+        'method': method,
+        'lapse_rate': lapse_rate,
+        'variables': variables,
+    }, default=str)
+    digest = hashlib.sha1(key.encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, f'{os.path.basename(store.rstrip("/"))}.{method}.{digest}.points.zarr')
+
+def extractStore(store: str, sites: dict, cache_dir: str, method: str = 'nearest', lapse_rate: float | None = None, variables: list[str] | None = None):
+    '''extractPoints for a zarr store, cached in cache_dir so repeat comparisons don't touch the gridded store'''
+    import xarray as xr
+    path = cachePath(cache_dir, store, sites, method, lapse_rate, variables)
+    if os.path.exists(path):
+        return xr.open_zarr(path)
+
+    ds = xr.open_zarr(store)
+    points = extractPoints(ds, sites, method, lapse_rate, variables)
+    points.attrs['source'] = store
+    os.makedirs(cache_dir, exist_ok=True)
+    points.chunk({'time': -1} if 'time' in points.dims else {}).to_zarr(path, mode='w')
+    return xr.open_zarr(path)
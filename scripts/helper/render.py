@@ -0,0 +1,245 @@
+import json
+import os
+import subprocess
+
+# numpy/xarray/dask/matplotlib/PIL are imported where they're used, so the skagit-met CLI can load this before argument parsing
+
+FORMATS = ['gif', 'mp4']
+# Frames spread over the animation that the GIF palette is built from, so colors that only show up later
+# (e.g. the peak of a storm) get palette entries too
+PALETTE_SAMPLE_FRAMES = 16
+
+# Set in each worker process by initWorker, so the figure and static layers are built once per process
+_worker = {}
+
+def boundaryRings(geojson: str) -> list:
+    '''Exterior rings of the boundary polygons as (lon, lat) arrays'''
+    import numpy as np
+    with open(geojson) as f:
+        features = json.load(f)['features']
+    rings = []
+    for feature in features:
+        geometry = feature['geometry']
+        polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+        rings += [np.asarray(polygon[0])[:, :2] for polygon in polygons]
+    return rings
+
+def hillshade(elevation, dx: float, dy: float, azimuth: float = 315, altitude: float = 45):
+    '''Lambertian hillshade (0-1) of an elevation grid with cell sizes dx, dy in the same units as elevation'''
+    import numpy as np
+    gy, gx = np.gradient(elevation, dy, dx)
+    slope = np.pi / 2 - np.arctan(np.hypot(gx, gy))
+    aspect = np.arctan2(-gx, gy)
+    azimuth, altitude = np.radians(azimuth), np.radians(altitude)
+    shaded = np.sin(altitude) * np.sin(slope) + np.cos(altitude) * np.cos(slope) * np.cos(azimuth - aspect)
+    return np.clip(shaded, 0, 1)
+
+def demLayer(dem_path: str, extent: tuple, max_pixels: int = 800) -> dict:
+    '''Hillshade of the DEM over extent (lon0, lon1, lat0, lat1), coarsened to about max_pixels across'''
+    import numpy as np
+    import rioxarray as rxr
+    dem = rxr.open_rasterio(dem_path, masked=True).squeeze(drop=True)
+    if dem.rio.crs is not None and dem.rio.crs.to_epsg() != 4326:
+        dem = dem.rio.reproject('EPSG:4326')
+    dem = dem.rio.clip_box(extent[0], extent[2], extent[1], extent[3])
+    factor = max(1, int(np.ceil(max(dem.shape) / max_pixels)))
+    dem = dem.coarsen(x=factor, y=factor, boundary='trim').mean()
+    lat0 = np.radians(float(dem.y.mean()))
+    # Degrees to meters so the slope is in the DEM's vertical units
+    dx = abs(float(dem.x[1] - dem.x[0])) * 111320 * np.cos(lat0)
+    dy = float(dem.y[1] - dem.y[0]) * 110540
+    return {
+        'shade': hillshade(dem.values, dx, dy),
+        'extent': (float(dem.x.min()), float(dem.x.max()), float(dem.y.min()), float(dem.y.max())),
+        'origin': 'upper' if dy < 0 else 'lower',
+    }
+
+def cellCorners(lat, lon):
+    '''Corner coordinates for pcolormesh from cell centers, for 1-D or 2-D lat/lon'''
+    import numpy as np
+    if lat.ndim == 1:
+        lon, lat = np.meshgrid(lon, lat)
+    def corners(a):
+        padded = np.pad(a, 1, mode='edge')
+        # Extrapolate the edges, then average the 4 surrounding centers
+        padded[0], padded[-1] = 2 * padded[1] - padded[2], 2 * padded[-2] - padded[-3]
+        padded[:, 0], padded[:, -1] = 2 * padded[:, 1] - padded[:, 2], 2 * padded[:, -2] - padded[:, -3]
+        return (padded[:-1, :-1] + padded[1:, :-1] + padded[:-1, 1:] + padded[1:, 1:]) / 4
+    return corners(lat), corners(lon)
+
+def staticLayers(ds, variable: str, geojson: str, dem_path: str | None = None, vmin: float | None = None, vmax: float | None = None) -> dict:
+    '''Everything that's the same in every frame, computed once and handed to the workers'''
+    import numpy as np
+    from helper.points import findLatLon
+    lat_name, lon_name = findLatLon(ds)
+    lat, lon = ds[lat_name].values, ds[lon_name].values
+    lat_corners, lon_corners = cellCorners(lat, lon)
+    extent = (float(np.nanmin(lon_corners)), float(np.nanmax(lon_corners)), float(np.nanmin(lat_corners)), float(np.nanmax(lat_corners)))
+    if vmin is None or vmax is None:
+        import dask
+        # One pass over the store for both ends of the color scale
+        data_min, data_max = dask.compute(ds[variable].min(), ds[variable].max())
+        vmin = float(data_min) if vmin is None else vmin
+        vmax = float(data_max) if vmax is None else vmax
+    return {
+        # Spatial dims in the order the mesh is laid out
+        'dims': ds[lat_name].dims if lat.ndim == 2 else (ds[lat_name].dims[0], ds[lon_name].dims[0]),
+        'lat': lat_corners,
+        'lon': lon_corners,
+        'extent': extent,
+        # Equirectangular axes, scaled so a km is as long north-south as east-west at the basin's latitude
+        'aspect': 1 / np.cos(np.radians((extent[2] + extent[3]) / 2)),
+        'boundary': boundaryRings(geojson),
+        'dem': demLayer(dem_path, extent) if dem_path else None,
+        'vmin': vmin,
+        'vmax': vmax,
+        'label': f'{variable} ({ds[variable].attrs.get("units", "")})' if ds[variable].attrs.get('units') else variable,
+    }
+
+def buildFigure(static: dict, cmap: str, width: int, height: int, dpi: int = 100):
+    import matplotlib
+    matplotlib.use('Agg')
+    import numpy as np
+    from matplotlib import pyplot as plt
+    fig = plt.figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+    ax = fig.add_axes([0.05, 0.05, 0.78, 0.88])
+    if static['dem'] is not None:
+        ax.imshow(static['dem']['shade'], extent=static['dem']['extent'], origin=static['dem']['origin'], cmap='gray', vmin=0, vmax=1)
+    empty = np.full((static['lat'].shape[0] - 1, static['lat'].shape[1] - 1), np.nan)
+    mesh = ax.pcolormesh(static['lon'], static['lat'], empty, cmap=cmap, vmin=static['vmin'], vmax=static['vmax'],
+                         alpha=0.8 if static['dem'] is not None else 1, shading='flat')
+    for ring in static['boundary']:
+        ax.plot(ring[:, 0], ring[:, 1], color='k', linewidth=1)
+    ax.set_xlim(static['extent'][0], static['extent'][1])
+    ax.set_ylim(static['extent'][2], static['extent'][3])
+    ax.set_aspect(static['aspect'])
+    colorbar = fig.colorbar(mesh, cax=fig.add_axes([0.86, 0.15, 0.03, 0.7]))
+    colorbar.set_label(static['label'])
+    title = ax.set_title('')
+    return fig, mesh, title
+
+def initWorker(store: str, variable: str, static: dict, cmap: str, width: int, height: int, resample: str, how: str) -> None:
+    _worker['frames'] = openFrames(store, variable, resample, how)
+    _worker['dims'] = static['dims']
+    _worker['size'] = (width, height)
+    _worker['figure'] = buildFigure(static, cmap, width, height)
+
+def openFrames(store: str, variable: str, resample: str | None = None, how: str = 'mean'):
+    import xarray as xr
+    from helper.packing import fromCellLayout
+    data = fromCellLayout(xr.open_zarr(store))[variable]
+    if resample:
+        data = getattr(data.resample(time=resample), how)()
+    return data
+
+def renderChunk(start: int, stop: int, palette: list[int] | None = None) -> list[bytes]:
+    '''Frames for time steps start:stop, read from the store in one go. Raw RGB, or palette indices when a palette is given'''
+    import numpy as np
+    fig, mesh, title = _worker['figure']
+    chunk = _worker['frames'].isel(time=slice(start, stop))
+    values = chunk.transpose('time', *_worker['dims']).values
+    frames = []
+    for i, time in enumerate(chunk.time.values):
+        mesh.set_array(values[i].ravel())
+        title.set_text(np.datetime_as_string(time, unit='h').replace('T', ' '))
+        fig.canvas.draw()
+        frame = np.asarray(fig.canvas.buffer_rgba())[:, :, :3].tobytes()
+        frames.append(quantize(frame, _worker['size'], palette) if palette else frame)
+    return frames
+
+def paletteImage(palette: list[int]):
+    from PIL import Image
+    image = Image.new('P', (1, 1))
+    image.putpalette(palette)
+    return image
+
+def samplePalette(frames: list[bytes], size: tuple[int, int]) -> list[int]:
+    '''One 256 color palette (flat RGB) for the whole animation, median cut over the sampled frames'''
+    from PIL import Image
+    width, height = size
+    sheet = Image.new('RGB', (width, height * len(frames)))
+    for i, frame in enumerate(frames):
+        sheet.paste(Image.frombytes('RGB', size, frame), (0, i * height))
+    palette = sheet.quantize(256, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE).getpalette()
+    return palette + [0] * (768 - len(palette))
+
+def quantize(frame: bytes, size: tuple[int, int], palette: list[int]) -> bytes:
+    from PIL import Image
+    return Image.frombytes('RGB', size, frame).quantize(palette=paletteImage(palette), dither=Image.Dither.NONE).tobytes()
+
+class GifStream:
+    '''Appends palette indexed frames to an open GIF file as they arrive, all sharing one global palette, so the
+    animation is never held in memory (PIL's save_all collects every frame before writing)'''
+    def __init__(self, handle, size: tuple[int, int], palette: list[int], fps: float):
+        self.handle = handle
+        self.size = size
+        self.palette = palette
+        self.duration = 1000 / fps
+        self.started = False
+
+    def write(self, indices: bytes) -> None:
+        from PIL import GifImagePlugin, Image
+        frame = Image.frombytes('P', self.size, indices)
+        frame.putpalette(self.palette)
+        if not self.started:
+            header, _ = GifImagePlugin.getheader(frame, info={'loop': 0})
+            self.handle.writelines(header)
+            self.started = True
+        self.handle.writelines(GifImagePlugin.getdata(frame, duration=self.duration))
+
+    def close(self) -> None:
+        if self.started:
+            self.handle.write(b';')
+
+def ffmpegCommand(output: str, width: int, height: int, fps: float) -> list[str]:
+    return ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-',
+            '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-crf', '20', output]
+
+def render(store: str, variable: str, output: str, geojson: str, dem_path: str | None = None, cmap: str = 'viridis', fps: float = 4,
+           width: int = 1000, height: int = 800, frames_per_chunk: int = 24, workers: int | None = None,
+           resample: str | None = None, how: str = 'mean', vmin: float | None = None, vmax: float | None = None) -> int:
+    '''Render variable of a zarr store to a GIF/MP4. Frames are drawn by a process pool, frames_per_chunk time steps
+    per task, and streamed in order as they finish to the GIF (quantized by the workers to one palette sampled across
+    the animation) or to ffmpeg for MP4, with at most two chunks per worker in flight'''
+    import multiprocessing
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+    from contextlib import nullcontext
+
+    import numpy as np
+    # Even sizes for yuv420p
+    width, height = width - width % 2, height - height % 2
+    frames = openFrames(store, variable, resample, how)
+    static = staticLayers(frames.to_dataset(), variable, geojson, dem_path, vmin, vmax)
+    n_frames = frames.sizes['time']
+    chunks = deque((start, min(start + frames_per_chunk, n_frames)) for start in range(0, n_frames, frames_per_chunk))
+    workers = workers or os.cpu_count()
+
+    written = 0
+    gif = output.endswith('.gif')
+    # Spawned rather than forked, forking after zarr/dask have started their threads can deadlock the workers
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'), initializer=initWorker,
+                             initargs=(store, variable, static, cmap, width, height, resample, how)) as executor, \
+            (open(output, 'wb') if gif else nullcontext()) as handle:
+        palette, encoder = None, None
+        if gif:
+            sample = np.unique(np.linspace(0, n_frames - 1, min(PALETTE_SAMPLE_FRAMES, n_frames)).round().astype(int))
+            sampled = [frame for future in [executor.submit(renderChunk, i, i + 1) for i in sample] for frame in future.result()]
+            palette = samplePalette(sampled, (width, height))
+            sink = GifStream(handle, (width, height), palette, fps)
+        else:
+            encoder = subprocess.Popen(ffmpegCommand(output, width, height, fps), stdin=subprocess.PIPE)
+            sink = encoder.stdin
+        in_flight = deque()
+        try:
+            while chunks or in_flight:
+                while chunks and len(in_flight) < 2 * workers:
+                    in_flight.append(executor.submit(renderChunk, *chunks.popleft(), palette))
+                for frame in in_flight.popleft().result():
+                    sink.write(frame)
+                    written += 1
+        finally:
+            sink.close()
+            if encoder is not None:
+                encoder.wait()
+    return written
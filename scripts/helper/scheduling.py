@@ -0,0 +1,79 @@
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from helper import instrumentation
+
+# Set by job_scheduler.py for the jobs it launches: directory holding the slot lock files and budget.json.
+# Without it slot() is a no-op, so downloaders run on their own exactly as before
+SLOTS_ENV = 'SKAGIT_MET_SLOTS'
+BUDGET_FILE = 'budget.json'
+SLOT_KINDS = ['network', 'cpu']
+POLL_SECONDS = 0.5
+LOCK_SUFFIX = '.lock'
+
+def addWorkDirArguments(parser, default: str = 'the output directory') -> None:
+    parser.add_argument('--workDir',
+                        type=str,
+                        help=f'Scratch directory for downloaded and extracted files, give each concurrent run its own. Defaults to {default}')
+
+def workDir(args, default: str) -> str:
+    '''The run's scratch directory, created if needed'''
+    work_dir = (args.workDir or default).rstrip('/') or '/'
+    os.makedirs(work_dir, exist_ok=True)
+    return work_dir
+
+def writeBudget(slots_dir: str, budget: dict) -> None:
+    os.makedirs(slots_dir, exist_ok=True)
+    with open(os.path.join(slots_dir, BUDGET_FILE), 'w') as f:
+        json.dump(budget, f)
+
+@contextmanager
+def storeLock(store: str):
+    '''Exclusive lock on a zarr store for the duration of a write, held through an flock on <store>.lock so
+    runs writing the same store from other processes wait instead of interleaving. The kernel drops the lock
+    if the process dies, so a crashed run never leaves the store locked'''
+    path = os.path.normpath(store) + LOCK_SUFFIX
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a') as handle:
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print(f'Waiting for another run writing {store}...')
+            with instrumentation.stage('wait', lock=path):
+                fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield path
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+@contextmanager
+def slot(kind: str):
+    '''Hold one of the scheduler's `kind` slots (network or cpu) for the block, waiting for a free one.
+    Slots are flock'd files <kind>.<i>.lock in the $SKAGIT_MET_SLOTS directory, shared by every job on the node'''
+    slots_dir = os.environ.get(SLOTS_ENV)
+    if not slots_dir:
+        yield None
+        return
+    with open(os.path.join(slots_dir, BUDGET_FILE)) as f:
+        size = json.load(f).get(kind, 1)
+
+    start = time.perf_counter()
+    while True:
+        for i in range(size):
+            with open(os.path.join(slots_dir, f'{kind}.{i}{LOCK_SUFFIX}'), 'a') as handle:
+                try:
+                    fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                waited = time.perf_counter() - start
+                if waited > POLL_SECONDS:
+                    instrumentation.count(f'{kind}_slot_wait_ms', int(waited * 1000))
+                try:
+                    yield handle.name
+                finally:
+                    fcntl.flock(handle, fcntl.LOCK_UN)
+                return
+        time.sleep(POLL_SECONDS)
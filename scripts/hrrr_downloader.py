@@ -1,17 +1,23 @@
-from herbie import Herbie, FastHerbie, wgrib2
-from shapely import vectorized
-import geopandas as gpd
-import pandas as pd
-import xarray as xr
-import numpy as np
-import dask as dask
-import cfgrib
+from __future__ import annotations
+
 import argparse
 import os
+from typing import TYPE_CHECKING
+
+from helper import derived, execution, geo, instrumentation, packing, scheduling
+
+# herbie, cfgrib, geopandas and xarray are imported where they are used, so --help stays fast
+if TYPE_CHECKING:
+    import xarray as xr
+    from herbie import FastHerbie, Herbie
+
+# A week of hourly data per chunk
+DEFAULT_TIME_CHUNK = 168
+
+DESCRIPTION = 'Download HRRR data using Herbie, and segment to a specific geographic region'
 
 # Parse command arguments from script run in the command line
-def setupArgs() -> None:
-    parser = argparse.ArgumentParser(description='Download HRRR data using Herbie, and segment to a specific geographic region')
+def addArguments(parser: argparse.ArgumentParser) -> None:
     parser.add_argument('--model', 
                         default='hrrr',
                         type=str,
@@ -45,9 +51,20 @@ def setupArgs() -> None:
                         default='data/weather_data/',
                         type=str,
                         help='Directory/path to download data/output zarr to.')
+    scheduling.addWorkDirArguments(parser)
+    execution.addExecutionArguments(parser, DEFAULT_TIME_CHUNK)
+    packing.addPackingArguments(parser)
+    derived.addDerivedArguments(parser)
+    instrumentation.addReportArguments(parser)
+
+def setupArgs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    addArguments(parser)
     return parser.parse_args()
 
 def getFastHerbie(start_date: str, end_date: str, model: str, product: str, save_dir: str ) -> FastHerbie:
+    import pandas as pd
+    from herbie import FastHerbie
     date_range = pd.date_range(
         start=start_date,
         end=end_date,
@@ -57,11 +74,13 @@ def getFastHerbie(start_date: str, end_date: str, model: str, product: str, save
 
 # Parse GeoJson File into tuple containing boundaries
 def parseGeoJson(geojson_path: str) -> tuple[float, float, float, float]:
+    import geopandas as gpd
     mask = gpd.read_file(geojson_path)
     minLon, minLat, maxLon, maxLat = mask.total_bounds
     return (minLon, maxLon, minLat, maxLat)
 
 def limitGeographicRange(bounds: tuple[float, float, float, float], subsetFiles: list) -> list:
+    from herbie import wgrib2
     return [wgrib2.region(f, bounds, name='skagit-basin') for f in subsetFiles]
 
 # Use Fast herbie to subset and download parameters
@@ -69,7 +88,10 @@ def downloadParameters(parameters: list[str], fh: FastHerbie) -> list[Herbie]:
     fields = [f":{param}" for param in  parameters]
     param_regex = fr"^(?:{'|'.join(fields)})"
     print("Search String: " + param_regex)
-    return fh.download(param_regex)
+    files = fh.download(param_regex)
+    instrumentation.count('files', len(files))
+    instrumentation.count('bytes', sum(os.path.getsize(f) for f in files if os.path.exists(f)))
+    return files
 
 def parseParameters(paramString: str) -> list[str]:
     return paramString.split(',')
@@ -78,22 +100,30 @@ def cleanUpFiles(subsetFiles:list) -> None:
     [os.unlink(f) for f in subsetFiles]
 
 def maskDataset(ds: xr.Dataset, mask_file: str) -> xr.Dataset:
+    import geopandas as gpd
+    from shapely import vectorized
     mask_shape = gpd.read_file(mask_file)
+    # wgrib2's lat/lon region still leaves a margin, crop to the basin's index box before masking
+    ds = ds.isel(geo.curvilinearWindow(ds.latitude.values, ds.longitude.values, mask_shape.geometry[0], ds.latitude.dims))
     mask = vectorized.contains(mask_shape.geometry[0], ds.longitude.values, ds.latitude.values)
     masked_data_set = ds.where(mask)
 
     return masked_data_set
 
 def mergeDatasets(regionSubsetGribFiles: list) -> xr.Dataset:
+    import cfgrib
+    import numpy as np
+    import xarray as xr
     datasets = []
     dropVars = ["surface", "heightAboveGround", "valid_time", "step"]
     # if f001, grab just the accumlated precip by dropping the other forecast variables
     dropVarsStep = dropVars + ["t", "r2", "si10", "sdswrf", "sdlwrf"]
     for f in regionSubsetGribFiles:
-        unMergedDatasets = cfgrib.open_datasets(f, indexpath='')
+        with instrumentation.stage('decode', file=str(f)):
+            unMergedDatasets = cfgrib.open_datasets(f, indexpath='')
         mergedDataset = xr.merge([ds.drop_vars(dropVarsStep, errors="ignore") if ds.step.values == np.timedelta64(1, 'h') else ds.drop_vars(dropVars, errors="ignore") for ds in unMergedDatasets])
-        mergedDataset.load()
-        datasets.append(mergedDataset)
+        # Stay lazy, the grib files are only read when the store is written
+        datasets.append(mergedDataset.chunk())
 
     other_vars = [ds for ds in datasets if 'tp' not in ds.variables]
     tp_f001 = [ds for ds in datasets if 'tp' in ds.variables]
@@ -106,27 +136,47 @@ def mergeDatasets(regionSubsetGribFiles: list) -> xr.Dataset:
 
     return combined_ds
 
-def write_to_zarr(dataset:xr.Dataset, output_dir: str, path:str) -> None:
+def storePath(output_dir: str, path: str) -> str:
     if output_dir[-1] == '/':
         output_dir = output_dir[:-1]
 
-    dataset.to_zarr(output_dir + '/' + path, mode='w')
-
-if __name__ == "__main__":
-    # Get Arguments - model, variables, product, date range, and geo_json
-    args = setupArgs()
-    parameters = parseParameters(args.parameters)
-    fh = getFastHerbie(args.startDate, args.endDate, args.model, args.product, args.outputDir)
-    fh_files = downloadParameters(parameters, fh)
-    bounds = parseGeoJson(args.geoJson)
-    geo_limited_files = limitGeographicRange(bounds, fh_files)
-    mergedDs = mergeDatasets(geo_limited_files)
-    maskedDs = maskDataset(mergedDs, args.geoJson)
-    write_to_zarr(maskedDs, args.outputDir, args.startDate + '_' + args.endDate + '_HRRR_data.zarr')
-    cleanUpFiles(fh_files)
-    cleanUpFiles([str(f) + '.idx' for f in geo_limited_files])
-    cleanUpFiles(geo_limited_files)
+    return output_dir + '/' + path
 
+def write_to_zarr(dataset:xr.Dataset, output_dir: str, path:str, encoding: dict | None = None) -> None:
+    dataset.to_zarr(storePath(output_dir, path), mode='w', encoding=encoding)
 
+def main(args: argparse.Namespace) -> None:
+    parameters = parseParameters(args.parameters)
+    store = args.startDate + '_' + args.endDate + '_HRRR_data.zarr'
+    with instrumentation.run('hrrr', storePath(args.outputDir, store), args, args.profile):
+        with instrumentation.stage('import'):
+            import cfgrib  # noqa: F401
+            import geopandas  # noqa: F401
+            import herbie  # noqa: F401
+            import xarray  # noqa: F401
+        with instrumentation.stage('list'):
+            fh = getFastHerbie(args.startDate, args.endDate, args.model, args.product, scheduling.workDir(args, args.outputDir))
+        with scheduling.slot('network'), instrumentation.stage('download'):
+            fh_files = downloadParameters(parameters, fh)
+        with instrumentation.stage('region'):
+            bounds = parseGeoJson(args.geoJson)
+            geo_limited_files = limitGeographicRange(bounds, fh_files)
+        # Merge and mask only build the dask graph, it runs chunk by chunk on the chosen backend during the write
+        with scheduling.slot('cpu'), execution.backendFromArgs(args):
+            with instrumentation.stage('merge'):
+                mergedDs = mergeDatasets(geo_limited_files)
+            with instrumentation.stage('mask'):
+                maskedDs = execution.timeChunked(maskDataset(mergedDs, args.geoJson), args.timeChunk)
+                if args.derived:
+                    maskedDs = derived.derive(maskedDs, 'hrrr')
+                maskedDs, encoding = packing.prepare(maskedDs, packing.specFromArgs('hrrr', args), args.cellLayout)
+            with scheduling.storeLock(storePath(args.outputDir, store)), instrumentation.stage('write', scheduler=args.scheduler):
+                write_to_zarr(maskedDs, args.outputDir, store, encoding)
+        with instrumentation.stage('cleanup'):
+            cleanUpFiles(fh_files)
+            cleanUpFiles([str(f) + '.idx' for f in geo_limited_files])
+            cleanUpFiles(geo_limited_files)
 
-    
+if __name__ == "__main__":
+    # Get Arguments - model, variables, product, date range, and geo_json
+    main(setupArgs())
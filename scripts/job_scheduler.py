@@ -0,0 +1,152 @@
+import argparse
+import importlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from helper import scheduling
+
+SKAGIT_MET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'skagit_met.py')
+DEFAULT_WORK_ROOT = os.path.join(tempfile.gettempdir(), 'skagit_met_jobs')
+DEFAULT_NETWORK_SLOTS = 4
+
+DESCRIPTION = '''Run a queue of skagit-met jobs (e.g. hrrr, wrf, prism, ornl, snotel pulls) in parallel on one node.
+                Every job gets its own scratch directory, writes to the same store wait on a lock on it, and download and
+                merge/write stages take slots from a network and a cpu budget shared by every scheduler using the same --workRoot.'''
+
+def addArguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--jobs',
+                        type=str,
+                        required=True,
+                        help='JSON file with a list of jobs: {"name": ..., "command": "prism", "args": ["--startDate", ...] or {"startDate": ...}}')
+    parser.add_argument('--maxJobs',
+                        type=int,
+                        help='Jobs running at once. Defaults to the network plus cpu slots, so there is always a job ready for a free slot')
+    parser.add_argument('--networkSlots',
+                        default=DEFAULT_NETWORK_SLOTS,
+                        type=int,
+                        help=f'Jobs downloading at once across the node. Defaults to {DEFAULT_NETWORK_SLOTS}')
+    parser.add_argument('--cpuSlots',
+                        type=int,
+                        help='Jobs merging/masking/writing at once across the node. Defaults to a quarter of the cores')
+    parser.add_argument('--workRoot',
+                        default=DEFAULT_WORK_ROOT,
+                        type=str,
+                        help=f'Directory for the job scratch directories, logs and slot locks. Defaults to {DEFAULT_WORK_ROOT}')
+    parser.add_argument('--keepWorkDirs',
+                        action='store_true',
+                        help='Keep the scratch directories of jobs that succeeded, failed jobs always keep theirs')
+
+def setupArgs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    addArguments(parser)
+    return parser.parse_args()
+
+class JobArgumentParser(argparse.ArgumentParser):
+    '''Raises the parse error instead of printing usage and exiting, so a bad job is reported with its message'''
+    def error(self, message: str):
+        raise ValueError(message)
+
+def jobArgv(args) -> list[str]:
+    '''A job's arguments as a command line, from a list or a {"option": value} dict'''
+    if isinstance(args, list):
+        return [str(a) for a in args]
+    argv = []
+    for option, value in args.items():
+        if value is False or value is None:
+            continue
+        argv.append(f'--{option}')
+        if value is not True:
+            argv += [str(v) for v in value] if isinstance(value, list) else [str(value)]
+    return argv
+
+def loadJobs(path: str) -> list[dict]:
+    '''Jobs from the queue file, each checked against its subcommand's parser before anything runs'''
+    from skagit_met import SUBCOMMANDS
+    with open(path) as f:
+        queue = json.load(f)
+    jobs = []
+    for i, job in enumerate(queue):
+        command = job.get('command')
+        if command not in SUBCOMMANDS or command == 'schedule':
+            print(f'Job {i} has an unknown command {command}. Skipping...')
+            continue
+        module = importlib.import_module(SUBCOMMANDS[command])
+        parser = JobArgumentParser(prog=f'skagit-met {command}')
+        module.addArguments(parser)
+        argv = jobArgv(job.get('args', []))
+        try:
+            parsed = parser.parse_args(argv)
+        except ValueError as e:
+            print(f'Job {i} ({job.get("name") or command}) has invalid arguments: {e}. Skipping...')
+            continue
+        jobs.append({
+            'name': job.get('name') or f'{command}_{i}',
+            'command': command,
+            'argv': argv,
+            # What the subcommand lets the scheduler fill in
+            'work_dir': hasattr(parsed, 'workDir') and parsed.workDir is None,
+            'workers': hasattr(parsed, 'workers') and parsed.workers is None,
+        })
+    return jobs
+
+def runJob(job: dict, work_root: str, workers: int, env: dict, keep: bool) -> dict:
+    '''Run one job as its own skagit-met process, in a fresh scratch directory, logging to <workRoot>/logs'''
+    work_dir = tempfile.mkdtemp(prefix=f'{job["name"]}_', dir=os.path.join(work_root, 'jobs'))
+    argv = list(job['argv'])
+    if job['work_dir']:
+        argv += ['--workDir', work_dir]
+    if job['workers']:
+        argv += ['--workers', str(workers)]
+    log_path = os.path.join(work_root, 'logs', f'{os.path.basename(work_dir)}.log')
+    start = time.perf_counter()
+    with open(log_path, 'w') as log:
+        log.write(' '.join(['skagit-met', job['command'], *argv]) + '\n')
+        log.flush()
+        returncode = subprocess.run([sys.executable, SKAGIT_MET, job['command'], *argv], stdout=log, stderr=subprocess.STDOUT, env=env,
+                                    check=False).returncode
+    if returncode == 0 and not keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {'name': job['name'], 'command': job['command'], 'returncode': returncode, 'duration_s': round(time.perf_counter() - start, 1),
+            'log': log_path, 'work_dir': work_dir}
+
+def main(args: argparse.Namespace) -> None:
+    jobs = loadJobs(args.jobs)
+    if len(jobs) == 0:
+        print('No valid jobs to run. Exiting...')
+        sys.exit(0)
+
+    cpus = os.cpu_count()
+    cpu_slots = args.cpuSlots or max(1, cpus // 4)
+    max_jobs = args.maxJobs or args.networkSlots + cpu_slots
+    # Each job merging/writing gets its share of the cores for its dask workers
+    workers = max(1, cpus // cpu_slots)
+    slots_dir = os.path.join(args.workRoot, 'slots')
+    scheduling.writeBudget(slots_dir, {'network': args.networkSlots, 'cpu': cpu_slots})
+    for sub in ['jobs', 'logs']:
+        os.makedirs(os.path.join(args.workRoot, sub), exist_ok=True)
+    env = dict(os.environ, **{scheduling.SLOTS_ENV: slots_dir})
+
+    print(f'Running {len(jobs)} jobs, {max_jobs} at a time, with {args.networkSlots} network and {cpu_slots} cpu slots ({workers} workers each)')
+    results = []
+    with ThreadPoolExecutor(max_jobs) as executor:
+        futures = [executor.submit(runJob, job, args.workRoot, workers, env, args.keepWorkDirs) for job in jobs]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            status = 'done' if result['returncode'] == 0 else f'FAILED ({result["returncode"]}), see {result["log"]}'
+            print(f'{result["name"]}: {status} in {result["duration_s"]} seconds')
+
+    summary_path = os.path.join(args.workRoot, f'schedule_{time.strftime("%Y%m%dT%H%M%S")}.json')
+    with open(summary_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    failed = [r['name'] for r in results if r['returncode'] != 0]
+    print(f'{len(results) - len(failed)} of {len(results)} jobs succeeded{", failed: " + ", ".join(failed) if failed else ""}. Summary in {summary_path}')
+
+if __name__ == '__main__':
+    main(setupArgs())
@@ -1,19 +1,27 @@
-import xarray as xr
-import rioxarray as rxr
-import fsspec
-from concurrent.futures import ThreadPoolExecutor, wait
-import pathlib
-from datetime import datetime as dt
-import dask as dask
-import geopandas as gpd
-import os
-import glob
+from __future__ import annotations
+
 import argparse
+import glob
+import os
+import pathlib
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING
+
 import helper.ornl_mapper as mapper
+from helper import derived, execution, instrumentation, packing, scheduling
+
+# fsspec, rioxarray, geopandas and xarray are imported where they are used, so --help stays fast
+if TYPE_CHECKING:
+    import xarray as xr
+
+CACHE_DIR = '/tmp/fsspec_cache'
+# A year of daily data per chunk, matching the yearly source files
+DEFAULT_TIME_CHUNK = 365
+
+DESCRIPTION = 'Download Daily ORNL 4KM downsampled data and clip to region and save as zarr. See https://hydrosource.ornl.gov/data/datasets/9505v3_1/'
 
 # Parse command arguments from script run in the command line
-def setupArgs() -> None:
-    parser = argparse.ArgumentParser(description='Download Daily ORNL 4KM downsampled data and clip to region and save as zarr. See https://hydrosource.ornl.gov/data/datasets/9505v3_1/')
+def addArguments(parser: argparse.ArgumentParser) -> None:
     parser.add_argument('--parameters', 
                         type=str,
                         default='',
@@ -58,45 +66,80 @@ def setupArgs() -> None:
                         choices=mapper.ALLOWED_DOWNSCALING_METHODS,
                         type=str,
                         help='Downscaling method used to downscale GCM data to 4KM resolution, e.g. DBCCA')
+    scheduling.addWorkDirArguments(parser, f'the shared fsspec cache {CACHE_DIR}')
+    execution.addExecutionArguments(parser, DEFAULT_TIME_CHUNK)
+    packing.addPackingArguments(parser)
+    derived.addDerivedArguments(parser)
+    instrumentation.addReportArguments(parser)
+
+def setupArgs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    addArguments(parser)
     return parser.parse_args()
     
-def pull_from_globus(url: str) -> str:
-    local_path = fsspec.open_local(f"simplecache::{url}", simplecache={'cache_storage': '/tmp/fsspec_cache'}, same_names=True)
+def pull_from_globus(url: str, cache_dir: str = CACHE_DIR) -> str:
+    import fsspec
+    # same_names keeps the remote file name in the cache, so an existing file is a cache hit
+    cached = os.path.exists(os.path.join(cache_dir, os.path.basename(url)))
+    local_path = fsspec.open_local(f"simplecache::{url}", simplecache={'cache_storage': cache_dir}, same_names=True)
+    if cached:
+        instrumentation.count('cache_hits')
+    else:
+        instrumentation.count('files')
+        instrumentation.count('bytes', os.path.getsize(local_path))
     return local_path
 
-def create_ornl_dataset(start_year: str, end_year: str, dest_path: str, geojson: str, reference: str, gcm: str, climate_scenario: str, downscaling_method: str) -> xr.Dataset:
-    
+def ornl_output_path(start_year: str, end_year: str, dest_path: str, reference: str, gcm: str, climate_scenario: str, downscaling_method: str) -> str:
     ref = False
     if gcm is None or climate_scenario is None or downscaling_method is None:
         ref = True
+
+    return f'{dest_path}/{start_year}_{end_year}{"_ref_" + reference  if ref else ""}{"_"+ gcm + "_" + climate_scenario + "_" + downscaling_method if not ref else ""}_ORNL_data.zarr'
+
+def create_ornl_dataset(start_year: str, end_year: str, dest_path: str, geojson: str, reference: str, gcm: str, climate_scenario: str, downscaling_method: str, time_chunk: int = DEFAULT_TIME_CHUNK,
+                        pack_spec: dict | None = None, cell_layout: bool = False, derive: bool = False, nc_files: list[str] | None = None) -> xr.Dataset:
+    import geopandas as gpd
+    import rioxarray as rxr
+    import xarray as xr
     
     #Output Zarr
-    output_file = f'{dest_path}/{start_year}_{end_year}{"_ref_" + reference  if ref else ""}{"_"+ gcm + "_" + climate_scenario + "_" + downscaling_method if not ref else ""}_ORNL_data.zarr'
+    output_file = ornl_output_path(start_year, end_year, dest_path, reference, gcm, climate_scenario, downscaling_method)
     
     # Collect Individual Variable Data arrays
     rasters = []
     mask = gpd.read_file(geojson)
-    nc_files = glob.iglob(os.path.join('/tmp/fsspec_cache/', '*.nc'))
+    # Only this run's files when given, the cache directory may be shared with other runs
+    nc_files = nc_files if nc_files is not None else glob.iglob(os.path.join(CACHE_DIR, '*.nc'))
     weather_dataset = None
 
     for f in nc_files:
         # open weather file and clip to watershed boundaries
         try:
-            raster = rxr.open_rasterio(f, masked=True)
-            raster = raster.rio.write_crs(mask.crs)
-            raster = raster.rio.clip(mask.geometry)
+            with instrumentation.stage('decode', file=f):
+                # Open lazily, nothing is read until the merged dataset is written
+                raster = rxr.open_rasterio(f, masked=True, chunks=True)
+                raster = raster.rio.write_crs(mask.crs)
+            with instrumentation.stage('region', file=f):
+                raster = raster.rio.clip(mask.geometry)
         except Exception as e:
             print(f'Error opening {f}: {e}\n Trying to continue...')
+            instrumentation.failure('decode', f, e)
             continue
 
         #add timestamp to list
         rasters.append(raster)
     
-    weather_dataset = xr.merge(rasters)
-    weather_dataset = weather_dataset.rename({'x': 'lon', 'y': 'lat'})
-    weather_dataset = weather_dataset.drop_vars('spatial_ref')
-    weather_dataset['time'] = weather_dataset.time.dt.floor('D')
-    weather_dataset.to_zarr(output_file, mode='w')
+    with instrumentation.stage('merge'):
+        weather_dataset = xr.merge(rasters)
+        weather_dataset = weather_dataset.rename({'x': 'lon', 'y': 'lat'})
+        weather_dataset = weather_dataset.drop_vars('spatial_ref')
+        weather_dataset['time'] = weather_dataset.time.dt.floor('D')
+        weather_dataset = execution.timeChunked(weather_dataset, time_chunk)
+        if derive:
+            weather_dataset = derived.derive(weather_dataset, 'ornl')
+        weather_dataset, encoding = packing.prepare(weather_dataset, pack_spec, cell_layout)
+    with scheduling.storeLock(output_file), instrumentation.stage('write'):
+        weather_dataset.to_zarr(output_file, mode='w', encoding=encoding)
     
     return weather_dataset
 
@@ -116,40 +159,51 @@ def parseParameters(paramString: str) -> list[str]:
 def clean_up_files(files:list) -> None:
     [pathlib.Path(f).unlink(missing_ok=True) for f in files]
 
-if __name__ == "__main__":
-    # Get Arguments - model, variables, product, date range, and geo_json
-    args = setupArgs()
+def downloaded_files(futures: list, files: list) -> list:
+    downloaded_files = []
+    for f, url in zip(futures, files):
+        try:
+            downloaded_files.append(f.result())
+        except Exception as e:
+            print(f"Error downloading file: {url}, exception: {e}")
+            instrumentation.failure('download', url, e)
+
+    return downloaded_files
+
+def main(args: argparse.Namespace) -> None:
     parameters = parseParameters(args.parameters)
     output_dir = args.outputDir
     if output_dir[-1] == '/':
         output_dir = output_dir[:-1]
 
-    files = mapper.generate_file_names(args.reference, args.hydroModel, parameters, args.startYear, args.endYear, args.gcm, args.climateScenario, args.downscalingMethod)
-    start_time = dt.now()
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        futures = [executor.submit(pull_from_globus, file) for file in files]
-        wait(futures)
+    output_file = ornl_output_path(args.startYear, args.endYear, output_dir, args.reference, args.gcm, args.climateScenario, args.downscalingMethod)
+    with instrumentation.run('ornl', output_file, args, args.profile):
+        with instrumentation.stage('import'):
+            import fsspec  # noqa: F401
+            import geopandas  # noqa: F401
+            import rioxarray  # noqa: F401
+        with instrumentation.stage('list'):
+            files = mapper.generate_file_names(args.reference, args.hydroModel, parameters, args.startYear, args.endYear, args.gcm, args.climateScenario, args.downscalingMethod)
+        cache_dir = scheduling.workDir(args, CACHE_DIR)
+        with scheduling.slot('network'), instrumentation.stage('download', requested=len(files)) as span:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                futures = [executor.submit(pull_from_globus, file, cache_dir) for file in files]
+                wait(futures)
 
-    def downloaded_files(futures: list) -> list:
-        downloaded_files = []
-        for f in futures:
-            try:
-                downloaded_files.append(f.result())
-            except Exception as e:
-                print(f"Error downloading file: {f}, exception: {e}")
-                pass
+            downloaded = downloaded_files(futures, files)
 
-        return downloaded_files
+        print('Time to download {} files: {} seconds'.format(len(downloaded), round(span['duration_s'])))
 
-    downloaded_files = downloaded_files(futures)
-    end_time = dt.now()
+        # Create Dataset, write out to zarr
+        with scheduling.slot('cpu'), execution.backendFromArgs(args):
+            create_ornl_dataset(args.startYear, args.endYear, output_dir, args.geojson,\
+                                args.reference, args.gcm, args.climateScenario, args.downscalingMethod, args.timeChunk,
+                                packing.specFromArgs('ornl', args), args.cellLayout, args.derived, downloaded)
 
-    print('Time to download {} files: {} seconds'.format(len(downloaded_files), (end_time - start_time).seconds))
+        # cleanup
+        with instrumentation.stage('cleanup'):
+            clean_up_files(downloaded)
 
-    # Create Dataset, write out to zarr
-    create_ornl_dataset(args.startYear, args.endYear, output_dir, args.geojson,\
-                        args.reference, args.gcm, args.climateScenario, args.downscalingMethod)
-
-    # cleanup
-    to_clean = glob.iglob(os.path.join('/tmp/fsspec_cache/', '*.nc'))
-    clean_up_files(to_clean)
\ No newline at end of file
+if __name__ == "__main__":
+    # Get Arguments - model, variables, product, date range, and geo_json
+    main(setupArgs())
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+from typing import TYPE_CHECKING
+
+from helper import derived, execution, geo, instrumentation, packing, scheduling
+
+# xarray/geopandas/shapely are imported where they are used, so --help stays fast
+if TYPE_CHECKING:
+    import xarray as xr
+
+ALLOWED_VARIABLES = ['GLW', 'PREC_ACC_NC', 'T2', 'Q2', 'SWDOWN', 'U10', 'V10']
+SCENARIOS = ['historical', 'HadGEM2_ES', 'CanESM2', 'CESM1_CAM5', 'GFDL_ESM2M', 'MPI_ESM_MR']
+DEFAULT_PNNL_DIR = '/data0/skagit_met/PNNL'
+GRID_FILE = 'historical/SERDP6km.geo_em.d01.nc'
+DEFAULT_TIME_CHUNK = 168
+
+DESCRIPTION = '''Extract PNNL WRF (6 km, hourly) data for the Skagit basin from the kerchunk parquet references (read with fsspec), and save as zarr.
+                Only the chunks covering the basin window are read, for the requested variables, scenarios and dates.'''
+
+def addArguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--startDate',
+                        type=str,
+                        required=True,
+                        help='Start date for data extraction, format YYYY-MM-DD')
+    parser.add_argument('--endDate',
+                        type=str,
+                        required=True,
+                        help='End date for data extraction (inclusive), format YYYY-MM-DD')
+    parser.add_argument('--scenarios',
+                        default='historical',
+                        type=str,
+                        help=f'Comma seperated string of scenarios, one store is written per scenario. Options are: {", ".join(SCENARIOS)}. Defaults to historical')
+    parser.add_argument('--parameters',
+                        default='',
+                        type=str,
+                        help=f'Comma seperated string of variables to keep. Options are: {", ".join(ALLOWED_VARIABLES)}. Defaults to all')
+    parser.add_argument('--pnnlDir',
+                        default=DEFAULT_PNNL_DIR,
+                        type=str,
+                        help='Directory holding <scenario>/PNNL_<scenario>.parquet references and the geo_em grid file')
+    parser.add_argument('--outputDir',
+                        default='data/weather_data/',
+                        type=str,
+                        help='Directory/path to output zarr to.')
+    parser.add_argument('--geojson',
+                        default='data/GIS/SkagitBoundary.json',
+                        type=str,
+                        help='Path to/name of geo_json file that geogrpahically limits the data')
+    execution.addExecutionArguments(parser, DEFAULT_TIME_CHUNK)
+    packing.addPackingArguments(parser)
+    derived.addDerivedArguments(parser)
+    instrumentation.addReportArguments(parser)
+
+def setupArgs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    addArguments(parser)
+    return parser.parse_args()
+
+def parseList(paramString: str, allowed: list[str], kind: str) -> list[str]:
+    param_list = [p.strip() for p in paramString.split(',') if p.strip()]
+    for p in param_list:
+        if p not in allowed:
+            print(f'{p} is not a valid PNNL {kind}. Skipping...')
+    return [p for p in param_list if p in allowed]
+
+def referencesPath(pnnl_dir: str, scenario: str) -> str:
+    return os.path.join(pnnl_dir, scenario, f'PNNL_{scenario}.parquet')
+
+def storePath(output_dir: str, start_date: str, end_date: str, scenario: str) -> str:
+    return os.path.join(output_dir, f'{start_date}_{end_date}_PNNL_{scenario}_data.zarr')
+
+def openGrid(grid_file: str) -> xr.Dataset:
+    '''CLAT/CLONG, land mask and terrain height of the PNNL grid, on the data files' (y, x) dims'''
+    import xarray as xr
+    grid = xr.open_dataset(grid_file).squeeze()  # Drop Time=0 scalar dimension
+    grid = grid[['CLAT', 'CLONG', 'LANDMASK', 'HGT_M']].rename({'south_north': 'y', 'west_east': 'x'})
+    return grid.rename({'CLAT': 'lat', 'CLONG': 'lon', 'HGT_M': 'hgt'}).load()
+
+def openBasinWindow(references: str, grid: xr.Dataset, window: dict, parameters: list[str], start_date: str, end_date: str) -> xr.Dataset:
+    '''Lazy view of the virtual store restricted to the basin window, variables and dates before anything is read'''
+    import xarray as xr
+    from fsspec.implementations.reference import LazyReferenceMapper
+    # The parquet references are read by fsspec (with pyarrow) and the chunks through the zarr engine, which is all
+    # engine='kerchunk' does. Opened unmasked like JoinPNNL.ipynb, fill values are turned into NaN here instead
+    pnnl = xr.open_dataset('reference://', engine='zarr', mask_and_scale=False, chunks={},
+                           backend_kwargs={'consolidated': False,
+                                           'storage_options': {'fo': LazyReferenceMapper(references, engine='pyarrow'), 'remote_protocol': 'file'}})
+    pnnl = pnnl[parameters].sel(time=slice(start_date, end_date)).isel(window)
+    for var in parameters:
+        fill = pnnl[var].attrs.pop('_FillValue', pnnl[var].encoding.get('_FillValue'))
+        # Source chunking/compression would clash with the rechunked write
+        pnnl[var].encoding = {}
+        if fill is not None:
+            pnnl[var] = pnnl[var].where(pnnl[var] != fill)
+    grid = grid.isel(window)
+    return pnnl.assign_coords(lat=grid.lat, lon=grid.lon, hgt=grid.hgt, LANDMASK=grid.LANDMASK)
+
+def maskDataset(ds: xr.Dataset, geometry) -> xr.Dataset:
+    from shapely import vectorized
+    mask = vectorized.contains(geometry, ds.lon.values, ds.lat.values)
+    return ds.where(mask)
+
+def main(args: argparse.Namespace) -> None:
+    scenarios = parseList(args.scenarios, SCENARIOS, 'scenario')
+    parameters = parseList(args.parameters, ALLOWED_VARIABLES, 'variable') or ALLOWED_VARIABLES
+    if len(scenarios) == 0:
+        print('No valid scenarios provided. Exiting...')
+        sys.exit(0)
+
+    for scenario in scenarios:
+        store = storePath(args.outputDir, args.startDate, args.endDate, scenario)
+        references = referencesPath(args.pnnlDir, scenario)
+        if not os.path.exists(references):
+            print(f'No references found at {references}, skipping {scenario}...')
+            continue
+        with instrumentation.run('pnnl', store, args, args.profile):
+            with instrumentation.stage('import'):
+                import fsspec  # noqa: F401
+                import geopandas as gpd
+            with instrumentation.stage('region'):
+                boundary = gpd.read_file(args.geojson).geometry[0]
+                grid = openGrid(os.path.join(args.pnnlDir, GRID_FILE))
+                window = geo.curvilinearWindow(grid.lat.values, grid.lon.values, boundary, grid.lat.dims)
+
+            # The window, variables and dates are selected lazily, so only the chunks overlapping them are
+            # fetched, concurrently on the chosen backend, during the write
+            with scheduling.slot('cpu'), execution.backendFromArgs(args):
+                with instrumentation.stage('list', scenario=scenario):
+                    pnnl = openBasinWindow(references, grid, window, parameters, args.startDate, args.endDate)
+                with instrumentation.stage('mask'):
+                    pnnl = execution.timeChunked(maskDataset(pnnl, boundary), args.timeChunk)
+                    if args.derived:
+                        pnnl = derived.derive(pnnl, 'pnnl')
+                    pnnl, encoding = packing.prepare(pnnl, packing.specFromArgs('pnnl', args), args.cellLayout)
+                pnnl.attrs['scenario'] = scenario
+                with scheduling.storeLock(store), instrumentation.stage('write', scheduler=args.scheduler):
+                    pnnl.to_zarr(store, mode='w', encoding=encoding)
+        print(f'{scenario}: {", ".join(pnnl.data_vars)} over {pnnl.sizes["time"]} hours written to {store}')
+
+if __name__ == '__main__':
+    main(setupArgs())
@@ -0,0 +1,64 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from helper import points
+
+DEFAULT_SITES = 'data/GIS/skagit_snotel_points.json'
+DEFAULT_CACHE_DIR = 'data/weather_data/points_cache/'
+
+DESCRIPTION = '''Extract (time, site) series at SNOTEL sites from gridded zarr stores (HRRR, WRF, PRISM, ORNL, PNNL) and cache them.
+                Only the cells around the sites are read, using a KD-tree over each product grid.'''
+
+def addArguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--stores',
+                        type=str,
+                        nargs='+',
+                        required=True,
+                        help='Gridded zarr stores written by the downloaders to extract from')
+    parser.add_argument('--sites',
+                        default=DEFAULT_SITES,
+                        type=str,
+                        help='SNOTEL zarr store from snotel_downloader.py, or a GeoJSON of points with id/name properties and elevation in feet')
+    parser.add_argument('--method',
+                        default='nearest',
+                        choices=points.METHODS,
+                        type=str,
+                        help='nearest cell, or bilinear (inverse distance of the 4 nearest cells on curvilinear grids). Defaults to nearest')
+    parser.add_argument('--lapseRate',
+                        type=float,
+                        help=f'Adjust temperatures from grid to site elevation with this lapse rate in K/km e.g. {points.DEFAULT_LAPSE_RATE}. Needs hgt/HGT/elevation in the store')
+    parser.add_argument('--variables',
+                        type=str,
+                        default='',
+                        help='Comma seperated string of variables to extract - defaults to all')
+    parser.add_argument('--cacheDir',
+                        default=DEFAULT_CACHE_DIR,
+                        type=str,
+                        help='Directory the extracted series are cached in')
+
+def setupArgs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    addArguments(parser)
+    return parser.parse_args()
+
+def parseVariables(paramString: str) -> list[str]:
+    param_list = paramString.split(',')
+    if not param_list[0]:
+        return None
+    return param_list
+
+def main(args: argparse.Namespace) -> None:
+    sites = points.loadSites(args.sites)
+    variables = parseVariables(args.variables)
+    print(f'Extracting {len(sites["site"])} sites from {len(args.stores)} stores...')
+
+    def extract(store: str):
+        ds = points.extractStore(store, sites, args.cacheDir, args.method, args.lapseRate, variables)
+        return points.cachePath(args.cacheDir, store, sites, args.method, args.lapseRate, variables), ds
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for path, ds in executor.map(extract, args.stores):
+            print(f'{path}: {", ".join(ds.data_vars)} over {ds.sizes.get("time", 0)} time steps')
+
+if __name__ == '__main__':
+    main(setupArgs())
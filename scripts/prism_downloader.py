@@ -1,16 +1,20 @@
-import rioxarray as rxr
-import xarray as xr
+from __future__ import annotations
+
+import argparse
 import os
-import requests
-import geopandas as gpd
-import pandas as pd
-from datetime import datetime as dt
-from datetime import timedelta
+import pathlib  # Python >= 3.4
 from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt
+from typing import TYPE_CHECKING
 from zipfile import ZipFile
-import pathlib  # Python >= 3.4
-import dask as dask
-import argparse
+
+from helper import derived, execution, instrumentation, packing, scheduling
+
+# rioxarray, geopandas, pandas and requests are imported where they are used, so --help stays fast
+if TYPE_CHECKING:
+    import geopandas as gpd
+    import pandas as pd
+    import xarray as xr
 
 BASE_URL = 'https://services.nacse.org/prism/data/get'
 # Format options, we need 
@@ -23,10 +27,13 @@ FORMAT_OPTIONS = ['nc', 'bil', 'asc', 'geotiff']
 DEFAULT_FREQUENCY = 'daily'
 FREQUENCY_OPTIONS = ['daily', 'monthly', 'annual']
 DEFAULT_PARAMS = ['tmean', 'tmax', 'tmin', 'ppt', 'vpdmax', 'vpdmin', 'tdmean']
+# A year of daily data per chunk
+DEFAULT_TIME_CHUNK = 365
 
-def setupArgs() -> None:
-    parser = argparse.ArgumentParser(description='''Download PRISM downsampled data and clip to region and save as zarr. See https://www.prism.oregonstate.edu/ and https://www.prism.oregonstate.edu/documents/PRISM_datasets.pdf
-                                     Uses the prism Webservice -- https://prism.oregonstate.edu/documents/PRISM_downloads_web_service.pdf''')
+DESCRIPTION = '''Download PRISM downsampled data and clip to region and save as zarr. See https://www.prism.oregonstate.edu/ and https://www.prism.oregonstate.edu/documents/PRISM_datasets.pdf
+                Uses the prism Webservice -- https://prism.oregonstate.edu/documents/PRISM_downloads_web_service.pdf'''
+
+def addArguments(parser: argparse.ArgumentParser) -> None:
     parser.add_argument('--parameters', 
                         type=str,
                         default=DEFAULT_PARAMS,
@@ -73,29 +80,46 @@ def setupArgs() -> None:
                         type=bool,
                         default=False,
                         help='Keep the zipped files after download. Default is False')
+    scheduling.addWorkDirArguments(parser)
+    execution.addExecutionArguments(parser, DEFAULT_TIME_CHUNK)
+    packing.addPackingArguments(parser)
+    derived.addDerivedArguments(parser)
+    instrumentation.addReportArguments(parser)
 
+def setupArgs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    addArguments(parser)
     return parser.parse_args()
 
-def create_prism_dataset(min_date: str, max_date: str, dest_path: str, boundaries_gdf: gpd.GeoDataFrame, zip_paths: list[str], frequency: str, resolution: str) -> xr.Dataset:
+def prism_output_path(min_date: str, max_date: str, dest_path: str, frequency: str, resolution: str) -> str:
+    return "%s/%s_%s_%s_%s_PRISM_data.zarr" % (dest_path, min_date, max_date, frequency, resolution)
+
+def create_prism_dataset(min_date: str, max_date: str, dest_path: str, boundaries_gdf: gpd.GeoDataFrame, zip_paths: list[str], frequency: str, resolution: str, time_chunk: int = DEFAULT_TIME_CHUNK,
+                         pack_spec: dict | None = None, cell_layout: bool = False, derive: bool = False, work_dir: str | None = None) -> xr.Dataset:
+    import rioxarray as rxr
+    import xarray as xr
     #Output Zarr
-    output_file = "%s/%s_%s_%s_%s_PRISM_data.zarr" % (dest_path, min_date, max_date, frequency, resolution)
+    output_file = prism_output_path(min_date, max_date, dest_path, frequency, resolution)
     
     # Collect Individual Variable Data arrays
     rasters = []
     nc_files = []
-    for zip_path in zip_paths:
-        with ZipFile(zip_path, 'r') as zip_ref:
-            nc_file = [f for f in zip_ref.namelist() if f.endswith('.nc')][0]
-            zip_ref.extract(nc_file, path=dest_path)
-            full_path = os.path.join(dest_path, nc_file)
-            variable = os.path.basename(nc_file).split('_')[1]
-            date = os.path.basename(nc_file).split('_')[4].split('.')[0]
-            nc_files.append({'full_path': full_path, 'variable': variable, 'date': date})
+    with instrumentation.stage('decode', files=len(zip_paths)):
+        for zip_path in zip_paths:
+            with ZipFile(zip_path, 'r') as zip_ref:
+                nc_file = [f for f in zip_ref.namelist() if f.endswith('.nc')][0]
+                zip_ref.extract(nc_file, path=work_dir or dest_path)
+                full_path = os.path.join(work_dir or dest_path, nc_file)
+                variable = os.path.basename(nc_file).split('_')[1]
+                date = os.path.basename(nc_file).split('_')[4].split('.')[0]
+                nc_files.append({'full_path': full_path, 'variable': variable, 'date': date})
 
     for f in nc_files:
        # open weather file and clip to watershed boundaries
-        raster = rxr.open_rasterio(f['full_path'], masked=True)
-        raster = raster.rio.clip(boundaries_gdf.to_crs(raster.rio.crs).geometry)
+        # Open lazily, nothing is read until the merged dataset is written
+        raster = rxr.open_rasterio(f['full_path'], masked=True, chunks=True)
+        with instrumentation.stage('region', file=f['full_path']):
+            raster = raster.rio.clip(boundaries_gdf.to_crs(raster.rio.crs).geometry)
     
         # get date from filename and add as a time coordinate
         # if frequency is daily, date is in YYYYMMDD format, else YYYYMM
@@ -114,12 +138,18 @@ def create_prism_dataset(min_date: str, max_date: str, dest_path: str, boundarie
         #add timestamp to list
         rasters.append(raster)
         
-    weather_dataset = xr.merge(rasters)
-    weather_dataset.to_zarr(output_file, mode='w')
+    with instrumentation.stage('merge'):
+        weather_dataset = execution.timeChunked(xr.merge(rasters), time_chunk)
+        if derive:
+            weather_dataset = derived.derive(weather_dataset, 'prism')
+        weather_dataset, encoding = packing.prepare(weather_dataset, pack_spec, cell_layout)
+    with scheduling.storeLock(output_file), instrumentation.stage('write'):
+        weather_dataset.to_zarr(output_file, mode='w', encoding=encoding)
     
     return weather_dataset
 
 def parseDateRange(startDateString: str, endDateString: str,  frequency: str) -> pd.DatetimeIndex:
+    import pandas as pd
     if frequency == 'daily':
         start_date = dt.strptime(startDateString, "%Y-%m-%d")
         end_date = dt.strptime(endDateString, "%Y-%m-%d")
@@ -144,62 +174,87 @@ def parseDateRange(startDateString: str, endDateString: str,  frequency: str) ->
 def clean_up_files(files: list) -> None:
     [pathlib.Path(f).unlink(missing_ok=True) for f in files]
 
-if __name__ == "__main__":
-    # Get Arguments - model, variables, product, date range, and geo_json
-    args = setupArgs()
+def extracted_files(zip_paths: list[str], dest_path: str) -> list[str]:
+    # Only what this run extracted, other runs may be using the same directory
+    files = []
+    for zip_path in zip_paths:
+        with ZipFile(zip_path, 'r') as zip_ref:
+            files += [os.path.join(dest_path, f) for f in zip_ref.namelist() if f.endswith('.nc')]
+    return files
+
+def main(args: argparse.Namespace) -> None:
     parameters = args.parameters
     dates = parseDateRange(args.startDate, args.endDate, args.frequency)
     output_dir = args.outputDir
     if output_dir[-1] == '/':
         output_dir = output_dir[:-1]
+    work_dir = scheduling.workDir(args, output_dir)
     
     # No Longer using FTP Client
     # '/us/4km/tmin/202204?format=nc'
     url_params = f'/{args.region}/{args.resolution}/'
     query_params = {'format': args.format}
 
-    def download(var, date, output_dir) -> str:
+    def download(var, date, work_dir) -> str:
         try:
-            zip_file_path = os.path.join(output_dir, f"{var}_{date}_{args.resolution}.zip")
+            zip_file_path = os.path.join(work_dir, f"{var}_{date}_{args.resolution}.zip")
             with requests.get(BASE_URL + url_params + var + '/' + date, params=query_params) as response:
                 response.raise_for_status()
                 with open(zip_file_path, 'wb') as zip_file:
                     for chunk in response.iter_content(chunk_size=8192):
                         zip_file.write(chunk)
+                        instrumentation.count('bytes', len(chunk))
+            instrumentation.count('files')
             return zip_file_path
         except Exception as e:
-            print(f"Failed to download for {var}")
-
-
-    start_time = dt.now()
-    futures = []
-    zip_paths = []
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        futures = [
-            executor.submit(download, var, date, output_dir)
-            for var in parameters for date in dates
-        ]
-        zip_paths = [future.result() for future in futures]
-
-    end_time = dt.now()
-
-    print('Time to download {} {}(s): {} seconds'.format(len(dates), args.frequency, (end_time - start_time).seconds))
-
-    # Create Dataset, write out to zarr
-    mask = gpd.read_file(args.geojson)
-    if args.format != 'nc':
-        print('Will only merge and write out to zarr if format is nc for now')
-    else:
-        print('Creating zarr dataset...')
-        create_prism_dataset(args.startDate, args.endDate, output_dir, mask, zip_paths, args.frequency, args.resolution)
-        print('Zarr dataset created...')
-
-    # cleanup
-    if args.keepZip:
-        print('Keeping zipped files...')
-    else:
-        print('Cleaning up zipped files...')
-        clean_up_files(zip_paths)
-    
-    print('Cleaning up extracted files...')
-    clean_up_files([os.path.join(output_dir, f) for f in os.listdir(output_dir) if f.endswith('.nc')])
\ No newline at end of file
+            print(f"Failed to download {var} for {date}: {e}")
+            instrumentation.failure('download', f'{var}/{date}', e)
+            return None
+
+    output_file = prism_output_path(args.startDate, args.endDate, output_dir, args.frequency, args.resolution)
+    with instrumentation.run('prism', output_file, args, args.profile):
+        with instrumentation.stage('import'):
+            import geopandas as gpd
+            import requests
+            import rioxarray  # noqa: F401
+        futures = []
+        zip_paths = []
+        with scheduling.slot('network'), instrumentation.stage('download', requested=len(dates) * len(parameters)) as span, \
+                ThreadPoolExecutor(max_workers=5) as executor:
+            futures = [
+                executor.submit(download, var, date, work_dir)
+                for var in parameters for date in dates
+            ]
+            zip_paths = [future.result() for future in futures]
+
+        # Failed downloads are recorded in the run report, only merge what came down
+        zip_paths = [f for f in zip_paths if f is not None]
+        print('Time to download {} {}(s): {} seconds'.format(len(dates), args.frequency, round(span['duration_s'])))
+
+        # Create Dataset, write out to zarr
+        mask = gpd.read_file(args.geojson)
+        if args.format != 'nc':
+            print('Will only merge and write out to zarr if format is nc for now')
+        elif len(zip_paths) == 0:
+            print('No files downloaded, skipping zarr creation...')
+        else:
+            print('Creating zarr dataset...')
+            with scheduling.slot('cpu'), execution.backendFromArgs(args):
+                create_prism_dataset(args.startDate, args.endDate, output_dir, mask, zip_paths, args.frequency, args.resolution, args.timeChunk,
+                                     packing.specFromArgs('prism', args), args.cellLayout, args.derived, work_dir)
+            print('Zarr dataset created...')
+
+        # cleanup
+        with instrumentation.stage('cleanup'):
+            print('Cleaning up extracted files...')
+            clean_up_files(extracted_files(zip_paths, work_dir) if args.format == 'nc' else [])
+
+            if args.keepZip:
+                print('Keeping zipped files...')
+            else:
+                print('Cleaning up zipped files...')
+                clean_up_files(zip_paths)
+
+if __name__ == "__main__":
+    # Get Arguments - model, variables, product, date range, and geo_json
+    main(setupArgs())
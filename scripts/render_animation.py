@@ -0,0 +1,88 @@
+import argparse
+import shutil
+import sys
+import time
+
+from helper import render
+
+DESCRIPTION = '''Render a variable of a gridded zarr store (HRRR, WRF, PNNL, PRISM, ORNL) to a GIF or MP4 map animation over the basin.
+                The boundary, DEM hillshade and map layout are prepared once, frames are drawn in parallel from the store a time chunk at a time
+                and streamed to the GIF (or to ffmpeg for MP4), so long animations render with bounded memory.'''
+
+def addArguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--store',
+                        type=str,
+                        required=True,
+                        help='Gridded zarr store written by the downloaders')
+    parser.add_argument('--variable',
+                        type=str,
+                        required=True,
+                        help='Variable to animate e.g. tp, T2C, ppt')
+    parser.add_argument('--output',
+                        type=str,
+                        required=True,
+                        help='Output file, .gif or .mp4')
+    parser.add_argument('--geojson',
+                        default='data/GIS/SkagitBoundary.json',
+                        type=str,
+                        help='Boundary drawn on every frame')
+    parser.add_argument('--dem',
+                        type=str,
+                        help='Optional DEM GeoTIFF (e.g. data/GIS/SkagitRiver_90mDEM.tif) drawn as a hillshade under the data')
+    parser.add_argument('--resample',
+                        type=str,
+                        help='Aggregate in time before rendering e.g. 1D for daily frames of an hourly product')
+    parser.add_argument('--how',
+                        default='mean',
+                        choices=['mean', 'sum', 'max', 'min'],
+                        type=str,
+                        help='How --resample aggregates, e.g. sum for precipitation. Defaults to mean')
+    parser.add_argument('--cmap',
+                        default='viridis',
+                        type=str,
+                        help='Matplotlib colormap. Defaults to viridis')
+    parser.add_argument('--vmin',
+                        type=float,
+                        help='Lower color limit. Defaults to the minimum over the store')
+    parser.add_argument('--vmax',
+                        type=float,
+                        help='Upper color limit. Defaults to the maximum over the store')
+    parser.add_argument('--fps',
+                        default=4,
+                        type=float,
+                        help='Frames per second. Defaults to 4')
+    parser.add_argument('--width',
+                        default=1000,
+                        type=int,
+                        help='Frame width in pixels. Defaults to 1000')
+    parser.add_argument('--height',
+                        default=800,
+                        type=int,
+                        help='Frame height in pixels. Defaults to 800')
+    parser.add_argument('--framesPerChunk',
+                        default=24,
+                        type=int,
+                        help='Time steps each worker reads and renders per task. Defaults to 24')
+    parser.add_argument('--workers',
+                        type=int,
+                        help='Number of rendering processes. Defaults to the number of cores')
+
+def setupArgs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    addArguments(parser)
+    return parser.parse_args()
+
+def main(args: argparse.Namespace) -> None:
+    if not args.output.endswith(tuple('.' + f for f in render.FORMATS)):
+        print(f'Output must end in one of: {", ".join(render.FORMATS)}. Exiting...')
+        sys.exit(0)
+    if args.output.endswith('.mp4') and shutil.which('ffmpeg') is None:
+        print('MP4 output needs ffmpeg on the PATH (e.g. conda install ffmpeg), GIF output does not. Exiting...')
+        sys.exit(0)
+    start = time.perf_counter()
+    frames = render.render(args.store, args.variable, args.output, args.geojson, args.dem, args.cmap, args.fps,
+                           args.width, args.height, args.framesPerChunk, args.workers, args.resample, args.how, args.vmin, args.vmax)
+    print(f'Rendered {frames} frames to {args.output} in {time.perf_counter() - start:.1f} seconds')
+
+if __name__ == '__main__':
+    main(setupArgs())
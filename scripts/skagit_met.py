@@ -0,0 +1,63 @@
+import time
+
+START = time.perf_counter()
+
+import argparse
+import importlib
+import sys
+
+from helper import instrumentation
+
+# Subcommand -> module in this directory. Each module exposes DESCRIPTION, addArguments(parser) and main(args),
+# and keeps its heavy imports inside functions, so building the parser here only costs argparse
+SUBCOMMANDS = {
+    'hrrr': 'hrrr_downloader',
+    'wrf': 'wrf_downloader',
+    'prism': 'prism_downloader',
+    'ornl': 'ornl_downloader',
+    'snotel': 'snotel_downloader',
+    'pnnl': 'pnnl_downloader',
+    'points': 'point_extractor',
+    'derive': 'derive_variables',
+    'harmonize': 'harmonize_products',
+    'events': 'ar_events',
+    'render': 'render_animation',
+    'forcing': 'forcing_exporter',
+    'schedule': 'job_scheduler',
+}
+
+# Modules that should never be loaded before a subcommand actually starts working
+HEAVY_MODULES = ['xarray', 'pandas', 'numpy', 'geopandas', 'rioxarray', 'dask', 'herbie', 'cfgrib',
+                 'boto3', 'botocore', 'fsspec', 'metloom', 'requests', 'shapely', 'zarr', 'matplotlib', 'netCDF4']
+
+def loadedHeavyModules() -> list[str]:
+    return [m for m in HEAVY_MODULES if m in sys.modules]
+
+def setupArgs(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='skagit-met', description='Download meteorological data for the Skagit River basin, save as zarr, and work with the stores')
+    parser.add_argument('--startupTime',
+                        action='store_true',
+                        help='Print how long the CLI took to reach the subcommand, and which heavy modules were already imported')
+    subparsers = parser.add_subparsers(dest='command', required=True, metavar='{' + ','.join(SUBCOMMANDS) + '}')
+    for name, module_name in SUBCOMMANDS.items():
+        module = importlib.import_module(module_name)
+        subparser = subparsers.add_parser(name, help=module.DESCRIPTION.split('.')[0], description=module.DESCRIPTION)
+        module.addArguments(subparser)
+        subparser.set_defaults(module=module_name)
+    return parser.parse_args(argv)
+
+def main(argv: list[str] | None = None) -> None:
+    args = setupArgs(argv)
+    startup = time.perf_counter() - START
+    loaded = loadedHeavyModules()
+    instrumentation.mark_startup(startup, loaded)
+    if args.startupTime:
+        print(f'Startup took {startup * 1000:.0f} ms, heavy modules loaded: {", ".join(loaded) or "none"}', file=sys.stderr)
+
+    module = sys.modules[args.module]
+    # Keep the run report args to the subcommand's own options
+    del args.module, args.startupTime
+    module.main(args)
+
+if __name__ == '__main__':
+    main()
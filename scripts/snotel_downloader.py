@@ -1,32 +1,32 @@
-from datetime import datetime
-import pandas as pd
-import geopandas as gpd
-from metloom.pointdata import SnotelPointData
-from metloom.variables import SnotelVariables
+from __future__ import annotations
+
 import argparse
-import xarray as xr
+import sys
+from datetime import datetime
 from pathlib import Path
-import requests
+from typing import TYPE_CHECKING
+
+from helper import derived, instrumentation, scheduling
+
+# metloom, geopandas, pandas and xarray are imported where they are used, so --help stays fast
+if TYPE_CHECKING:
+    import geopandas as gpd
+    import pandas as pd
+    import xarray as xr
+    from metloom.pointdata import SnotelPointData
+    from metloom.variables import SnotelVariables
 
-DEFAULT_SNOTEL_VARS = [SnotelPointData.ALLOWED_VARIABLES.SNOWDEPTH,
-            SnotelPointData.ALLOWED_VARIABLES.SWE,
-            SnotelPointData.ALLOWED_VARIABLES.PRECIPITATION,
-            SnotelPointData.ALLOWED_VARIABLES.PRECIPITATIONACCUM,
-            SnotelPointData.ALLOWED_VARIABLES.TEMP,
-            SnotelPointData.ALLOWED_VARIABLES.TEMPAVG,
-            SnotelPointData.ALLOWED_VARIABLES.TEMPMAX,
-            SnotelPointData.ALLOWED_VARIABLES.TEMPMIN]
 ALLOWED_SNOTEL_VARS = ['SNOWDEPTH', 'SWE', 'PRECIPITATION', 'ACCUMULATED PRECIPITATION', 'AIR TEMP', 'AVG AIR TEMP', 'MAX AIR TEMP']
-SNOTEL_VAR_LOOKUP = dict(zip(ALLOWED_SNOTEL_VARS, DEFAULT_SNOTEL_VARS))
 FREQUENCY_CHOICES = ['hourly', 'daily']
 DEFAULT_FREQUENCY = 'hourly'
 DEFAULT_GEOJSON = 'data/GIS/SkagitBoundary.json'
 DEFAULT_OUTPUT_DIR = 'data/weather_data/'
 
+DESCRIPTION = '''Download Snotel point data and save as zarr.
+                                      See https://www.nrcs.usda.gov/wps/portal/wcc/home/aboutUs/monitoringPrograms/automatedSnowMonitoring/ and https://metloom.readthedocs.io/en/latest/'''
+
 # Parse command arguments from script run in the command line
-def setupArgs() -> argparse.Namespace:
-    parser = argparse.ArgumentParser(description='''Download Snotel point data and save as zarr.
-                                      See https://www.nrcs.usda.gov/wps/portal/wcc/home/aboutUs/monitoringPrograms/automatedSnowMonitoring/ and https://metloom.readthedocs.io/en/latest/''')
+def addArguments(parser: argparse.ArgumentParser) -> None:
     group = parser.add_mutually_exclusive_group()
     parser.add_argument('--variables', 
                         type=str,
@@ -64,43 +64,74 @@ def setupArgs() -> argparse.Namespace:
                         type=str,
                         choices=FREQUENCY_CHOICES,
                         help='Frequency of data to download. Options are daily or hourly. Defaults to hourly')
+    derived.addDerivedArguments(parser)
+    instrumentation.addReportArguments(parser)
+
+def setupArgs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    addArguments(parser)
     return parser.parse_args()
 
+def defaultSnotelVars() -> list[SnotelVariables]:
+    from metloom.pointdata import SnotelPointData
+    return [SnotelPointData.ALLOWED_VARIABLES.SNOWDEPTH,
+            SnotelPointData.ALLOWED_VARIABLES.SWE,
+            SnotelPointData.ALLOWED_VARIABLES.PRECIPITATION,
+            SnotelPointData.ALLOWED_VARIABLES.PRECIPITATIONACCUM,
+            SnotelPointData.ALLOWED_VARIABLES.TEMP,
+            SnotelPointData.ALLOWED_VARIABLES.TEMPAVG,
+            SnotelPointData.ALLOWED_VARIABLES.TEMPMAX,
+            SnotelPointData.ALLOWED_VARIABLES.TEMPMIN]
+
+def snotelVarLookup() -> dict[str, SnotelVariables]:
+    return dict(zip(ALLOWED_SNOTEL_VARS, defaultSnotelVars()))
+
 def parseVariables(paramString: str) -> tuple[list[str], list[SnotelVariables]]:
     var_list = paramString.split(',')
     if not var_list[0]:
-        return ALLOWED_SNOTEL_VARS, DEFAULT_SNOTEL_VARS
+        return ALLOWED_SNOTEL_VARS, defaultSnotelVars()
     else:
         # Let user nkow variable not allowed, but continue with rest
+        lookup = snotelVarLookup()
         var_strs = []
         for var in var_list:
-            if var.strip() not in SNOTEL_VAR_LOOKUP:
+            if var.strip() not in lookup:
                 print(f'{var} is not a valid Snotel variable. Skipping...')
             else:
                 var_strs.append(var.strip())
         # Try to get some variables 
-        return var_strs, [SNOTEL_VAR_LOOKUP[var.strip()] for var in var_strs]
+        return var_strs, [lookup[var.strip()] for var in var_strs]
 
 def parseStationIDs(paramString: str) -> list[str]:
     return paramString.split(',')
 
 def getStationData(stations: list[str], frequency: str, start: datetime, end: datetime, variables: list[SnotelVariables], var_strs: list[str]) -> xr.Dataset:
-    points = [SnotelPointData(station, '') for station in stations]
-    dfs = [getDataByFrequency(point, frequency, start, end, variables) for point in points]
-    return createDataset(dfs, frequency, var_strs)
+    from metloom.pointdata import SnotelPointData
+    with instrumentation.stage('list'):
+        points = [SnotelPointData(station, '') for station in stations]
+    with instrumentation.stage('download', requested=len(points)):
+        dfs = [getDataByFrequency(point, frequency, start, end, variables) for point in points]
+    with instrumentation.stage('merge'):
+        return createDataset(dfs, frequency, var_strs)
 
 def getGeometryData(geojson: str, frequency: str, start: datetime, end: datetime, variables: list[SnotelVariables], var_strs: list[str]) -> xr.Dataset:
-    geometry = gpd.read_file(geojson)
-    points = SnotelPointData.points_from_geometry(geometry, variables)
-    dfs = [getDataByFrequency(point, frequency, start, end, variables) for point in points]
-    return createDataset(dfs, frequency, var_strs)
+    import geopandas as gpd
+    from metloom.pointdata import SnotelPointData
+    with instrumentation.stage('list'):
+        geometry = gpd.read_file(geojson)
+        points = SnotelPointData.points_from_geometry(geometry, variables)
+    with instrumentation.stage('download', requested=len(points)):
+        dfs = [getDataByFrequency(point, frequency, start, end, variables) for point in points]
+    with instrumentation.stage('merge'):
+        return createDataset(dfs, frequency, var_strs)
     
 def createDataset(dataframes: list[gpd.GeoDataFrame], frequency: str, var_strs: list[str]) -> xr.Dataset:
+    import pandas as pd
     try:
         snotel_df = pd.concat(dataframes)
     except ValueError:
         print('No variable data found for the given stations on given dates. Exiting...')
-        exit(0)
+        sys.exit(0)
     # Sort by date:
     snotel_df.sort_index(level=0, inplace=True)
     # Convert to xarray dataset and make sure in correct datetime format
@@ -147,6 +178,8 @@ def createDataset(dataframes: list[gpd.GeoDataFrame], frequency: str, var_strs:
     return snotel_xr
 
 def getDataByFrequency(point: SnotelPointData, frequency: str, start: datetime, end: datetime, variables: list[SnotelVariables]) -> pd.DataFrame:
+    import pandas as pd
+    import requests
     try:
         df = pd.DataFrame()
         if frequency == 'hourly':
@@ -161,24 +194,29 @@ def getDataByFrequency(point: SnotelPointData, frequency: str, start: datetime,
             return pd.DataFrame()
         else:
             df['site_name'] = point.name
+            instrumentation.count('files')
+            instrumentation.count('bytes', int(df.memory_usage(deep=True).sum()))
         return df
     except requests.exceptions.HTTPError as e:
         print(f'Error downloading data for {point.station_id}. Skipping...')
+        instrumentation.failure('download', point.station_id, e)
         return pd.DataFrame()
     
+def snotelOutputPath(output_dir: str, startDate: str, endDate: str, frequency: str) -> str:
+    return "%s/%s_%s_SNOTEL_%s_data.zarr" % (output_dir, startDate, endDate, frequency)
+
 def writeToZarr(ds: xr.Dataset, output_dir: str, startDate: str, endDate: str, frequency: str) -> None:
     #Output Zarr
-    output_file = "%s/%s_%s_SNOTEL_%s_data.zarr" % (output_dir, startDate, endDate, frequency)
+    output_file = snotelOutputPath(output_dir, startDate, endDate, frequency)
 
     ds.to_zarr(output_file, mode='w')
 
-if __name__ == '__main__':
-    args = setupArgs()
+def main(args: argparse.Namespace) -> None:
     var_strs, variables = parseVariables(args.variables)
     # Return if no valid vars
     if len(variables) == 0:
         print('No valid variables provided. Exiting....')
-        exit(0)
+        sys.exit(0)
     
     output_dir = args.outputDir
     if output_dir[-1] == '/':
@@ -186,7 +224,7 @@ if __name__ == '__main__':
     # Verify Output Dir
     if not Path(output_dir).exists():
         print(f'Output directory {output_dir} does not exist. Try creating before running. Exiting...')
-        exit(0)
+        sys.exit(0)
     
     # Dates
     try:
@@ -196,16 +234,26 @@ if __name__ == '__main__':
         raise ValueError('Dates must be in the format YYYY-MM-DD')
     
     startTime = datetime.now()
-    if args.stationIDs:
-        stationIDs = parseStationIDs(args.stationIDs)
-        if len(stationIDs) == 0:
-            print('No station IDs provided. Exiting...')
-            exit(0)
-        xr = getStationData(stationIDs, args.frequency, startDate, endDate, variables, var_strs)
-    else:
-        xr = getGeometryData(args.geojson, args.frequency, startDate, endDate, variables, var_strs)
-    
-    writeToZarr(xr, output_dir, args.startDate, args.endDate, args.frequency)
-    endTime = datetime.now()
-    print('Time to download: {} seconds'.format((endTime - startTime).seconds))
-    
\ No newline at end of file
+    with instrumentation.run('snotel', snotelOutputPath(output_dir, args.startDate, args.endDate, args.frequency), args, args.profile):
+        with instrumentation.stage('import'):
+            import geopandas  # noqa: F401
+            import xarray  # noqa: F401
+        with scheduling.slot('network'):
+            if args.stationIDs:
+                stationIDs = parseStationIDs(args.stationIDs)
+                if len(stationIDs) == 0:
+                    print('No station IDs provided. Exiting...')
+                    sys.exit(0)
+                ds = getStationData(stationIDs, args.frequency, startDate, endDate, variables, var_strs)
+            else:
+                ds = getGeometryData(args.geojson, args.frequency, startDate, endDate, variables, var_strs)
+        if args.derived:
+            ds = derived.derive(ds, 'snotel')
+
+        with scheduling.storeLock(snotelOutputPath(output_dir, args.startDate, args.endDate, args.frequency)), instrumentation.stage('write'):
+            writeToZarr(ds, output_dir, args.startDate, args.endDate, args.frequency)
+        endTime = datetime.now()
+        print('Time to download: {} seconds'.format((endTime - startTime).seconds))
+
+if __name__ == '__main__':
+    main(setupArgs())
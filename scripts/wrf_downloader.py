@@ -1,29 +1,38 @@
-import boto3.exceptions
-import pandas as pd
-import geopandas as gpd
-import xarray as xr
-import dask as dask
+from __future__ import annotations
+
 import argparse
 import os
-import boto3
-from botocore import UNSIGNED
-from botocore.client import Config
-from botocore.exceptions import ClientError
-from datetime import datetime as dt
 from concurrent.futures import ThreadPoolExecutor
-from shapely import vectorized
+from functools import cache
+from typing import TYPE_CHECKING
+
+from helper import derived, execution, geo, instrumentation, packing, scheduling
+
+# boto3, geopandas and xarray are imported where they are used, so --help stays fast
+if TYPE_CHECKING:
+    import xarray as xr
 
 BUCKET_NAME = 'wrf-cmip6-noversioning'
-config = Config(
-    signature_version = UNSIGNED,
-    max_pool_connections = 24,
-    retries = {'mode': 'standard', 'max_attempts': 10}
-)
-s3 = boto3.client('s3', config=config)
+# A week of hourly data per chunk
+DEFAULT_TIME_CHUNK = 168
+
+# Built on first use and shared by the download threads, boto3 clients are thread safe
+@cache
+def getS3Client():
+    import boto3
+    from botocore import UNSIGNED
+    from botocore.client import Config
+    config = Config(
+        signature_version = UNSIGNED,
+        max_pool_connections = 24,
+        retries = {'mode': 'standard', 'max_attempts': 10}
+    )
+    return boto3.client('s3', config=config)
+
+DESCRIPTION = 'Download WRF downsampled data and clip to region and save as zarr. See https://dept.atmos.ucla.edu/sites/default/files/alexhall/files/aws_tiers_dirstructure_nov22.pdf'
 
 # Parse command arguments from script run in the command line
-def setupArgs() -> None:
-    parser = argparse.ArgumentParser(description='Download WRF downsampled data and clip to region and save as zarr. See https://dept.atmos.ucla.edu/sites/default/files/alexhall/files/aws_tiers_dirstructure_nov22.pdf')
+def addArguments(parser: argparse.ArgumentParser) -> None:
     parser.add_argument('--model', 
                         required=True,
                         type=str,
@@ -64,9 +73,19 @@ def setupArgs() -> None:
                         default='data/GIS/SkagitBoundary.json',
                         type=str,
                         help='Path to/name of geo_json file that geogrpahically limits the downloaded data')
+    scheduling.addWorkDirArguments(parser)
+    execution.addExecutionArguments(parser, DEFAULT_TIME_CHUNK)
+    packing.addPackingArguments(parser)
+    derived.addDerivedArguments(parser)
+    instrumentation.addReportArguments(parser)
+
+def setupArgs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    addArguments(parser)
     return parser.parse_args()
 
 def generateFileNames(start_date: str, end_date: str, model: str, data_tier: int, domain: int, historical: bool, bias_correction: bool) -> list[str]:
+    import pandas as pd
     r = pd.date_range(start_date, end_date, freq='1h', inclusive='both', normalize=True)
     file_prefix = {1: "wrfout", 2: "auxhist"}
     path_prefix = "downscaled_products/gcm"
@@ -77,18 +96,24 @@ def generateFileNames(start_date: str, end_date: str, model: str, data_tier: int
     return ["%s/%s/d0%s/%s_d01_%s" % (path, d.year if d.month > 9 else d.year - 1, domain, file_prefix[data_tier], pd.to_datetime(d).strftime('%Y-%m-%d_%H:%M:%S')) for d in r]
 
 def downloadS3File(bucket: str, file: str, output_dir: str) -> str:
+    from botocore.exceptions import ClientError
     if output_dir[-1] == '/':
         output_dir = output_dir[:-1]
     output_file = "%s/%s_%s.nc" % (output_dir, file.split('/')[2], file.split('/')[-1].replace(':', '-'))
     try:
-        s3.download_file(bucket, file, output_file)
+        getS3Client().download_file(bucket, file, output_file)
     except ClientError as e:
         print(f"Failed to download {file} from S3:  {e.response}")
+        instrumentation.count('retries', e.response.get('ResponseMetadata', {}).get('RetryAttempts', 0))
+        instrumentation.failure('download', file, e)
         return None
 
+    instrumentation.count('files')
+    instrumentation.count('bytes', os.path.getsize(output_file))
     return output_file
 
 def downloadMetadataFile(domain: int, output_dir: str, coord: bool = False) -> str:
+    from botocore.exceptions import ClientError
     if output_dir[-1] == '/':
         output_dir = output_dir[:-1]
     file_name = f'wrfinput_d0{domain}{"_coord.nc" if coord else ""}'
@@ -96,13 +121,17 @@ def downloadMetadataFile(domain: int, output_dir: str, coord: bool = False) -> s
     output_file = "%s/%s" % (output_dir, file_name)
 
     try:
-        s3.download_file(BUCKET_NAME, s3_path, output_file)
+        getS3Client().download_file(BUCKET_NAME, s3_path, output_file)
+        instrumentation.count('files')
+        instrumentation.count('bytes', os.path.getsize(output_file))
     except ClientError as e:
         print(f"Failed to download metadata at {file_name} from S3")
+        instrumentation.failure('download', s3_path, e)
     
     return output_file
 
 def getLatLonHgtFromMetadata(metadata_file: str) -> tuple[xr.DataArray, xr.DataArray, xr.DataArray]:
+    import xarray as xr
     data = xr.open_dataset(metadata_file)
     lat = data.variables["XLAT"]
     lon = data.variables["XLONG"]
@@ -118,6 +147,7 @@ def getLatLonHgtFromMetadata(metadata_file: str) -> tuple[xr.DataArray, xr.DataA
     return (lat_wrf, lon_wrf, hgt_wrf)
 
 def formatWrfArray(wrf_data: xr.Dataset, lat: xr.DataArray, lon: xr.DataArray, hgt: xr.DataArray, parameters_to_keep: list[str]) -> xr.Dataset:
+    import pandas as pd
     wrf_data = wrf_data.assign_coords(lat=lat, lon=lon, hgt=hgt).rename({'south_north': 'y', 'west_east': 'x'})
     time_strs = wrf_data['Times'].astype(str)
     time_strs = [t.replace("_", " ") for t in time_strs.values]
@@ -130,11 +160,25 @@ def formatWrfArray(wrf_data: xr.Dataset, lat: xr.DataArray, lon: xr.DataArray, h
     return wrf_data
 
 def geoMaskWrfArray(wrf_array: xr.Dataset, gejson_path: str) -> xr.Dataset:
+    import geopandas as gpd
+    from shapely import vectorized
     boundary = gpd.read_file(gejson_path)
+    # Crop the full domain to the basin's index box first, so only those cells are read, masked and written
+    wrf_array = wrf_array.isel(geo.curvilinearWindow(wrf_array.lat.values, wrf_array.lon.values, boundary.geometry[0], wrf_array.lat.dims))
     mask = vectorized.contains(boundary.geometry[0], wrf_array.lon.values, wrf_array.lat.values)
     
     return wrf_array.where(mask)
 
+def addStepPrecipitation(wrf_array: xr.Dataset) -> xr.Dataset:
+    '''Add PREC_ACC, the precipitation over each hourly step. RAINC and RAINNC are running totals since the start of the run,
+    so they are summed and de-accumulated here once, lazily, and nothing downstream has to diff them'''
+    if not {'RAINC', 'RAINNC'} <= set(wrf_array.data_vars):
+        return wrf_array
+    step = execution.deaccumulate(wrf_array['RAINC'] + wrf_array['RAINNC'])
+    wrf_array['PREC_ACC'] = step.astype('float32').assign_attrs(units='mm', long_name='Total precipitation over the time step',
+                                                                 derived_from='RAINC,RAINNC')
+    return wrf_array
+
 def parseParameters(paramString: str) -> list[str]:
     param_list = paramString.split(',')
     if not param_list[0]:
@@ -144,43 +188,67 @@ def parseParameters(paramString: str) -> list[str]:
 def cleanUpFiles(files:list) -> None:
     [os.unlink(f) for f in files]
 
-def write_to_zarr(dataset:xr.Dataset, output_dir: str, path:str) -> None:
+def storePath(output_dir: str, path: str) -> str:
     if output_dir[-1] == '/':
         output_dir = output_dir[:-1]
-    
-    dataset.to_zarr(output_dir + '/' + path, mode='w')
+
+    return output_dir + '/' + path
+
+def write_to_zarr(dataset:xr.Dataset, output_dir: str, path:str, encoding: dict | None = None) -> None:
+    dataset.to_zarr(storePath(output_dir, path), mode='w', encoding=encoding)
+
+def main(args: argparse.Namespace) -> None:
+    parameters = parseParameters(args.parameters)
+    store = args.startDate + '_' + args.endDate + '_wrf_' + args.model + '_data.zarr'
+    work_dir = scheduling.workDir(args, args.outputDir)
+    with instrumentation.run('wrf', storePath(args.outputDir, store), args, args.profile):
+        with instrumentation.stage('import'):
+            import boto3  # noqa: F401
+            import geopandas  # noqa: F401
+            import xarray as xr
+            getS3Client()
+        with instrumentation.stage('list'):
+            files_to_download = generateFileNames(args.startDate, args.endDate, args.model, args.dataTier, args.domain, args.historical, args.biasCorrected)
+
+        # Download 24 hrs at a time
+        with scheduling.slot('network'), instrumentation.stage('download', requested=len(files_to_download)) as span, \
+                ThreadPoolExecutor(24) as executor:
+            downloaded_files = list(executor.map(lambda file: downloadS3File(BUCKET_NAME, file, work_dir), files_to_download))
+
+        failed_files = [f for f in downloaded_files if f is None]
+        downloaded_files = [f for f in downloaded_files if f is not None]
+        print('Time to download {} files: {} seconds'.format(len(downloaded_files), round(span['duration_s'])))
+        print(f'{len(failed_files)} failed to download')
+
+        if len(downloaded_files) == 0:
+            print('No files downloaded. Exiting...')
+            return
+
+        # Get Metadata File for Lat, Lon
+        with instrumentation.stage('download', metadata=True):
+            md_file = downloadMetadataFile(args.domain, work_dir)
+        with instrumentation.stage('decode'):
+            lat, lon, hgt = getLatLonHgtFromMetadata(md_file)
+
+        # Format, then geo limit by masking. Files are opened in parallel and everything after stays lazy,
+        # so the graph runs chunk by chunk on the chosen backend during the write
+        with scheduling.slot('cpu'), execution.backendFromArgs(args):
+            with instrumentation.stage('merge'):
+                wrf_array = xr.open_mfdataset(downloaded_files, combine='nested', concat_dim='Time', parallel=True)
+                wrf_array_formatted = formatWrfArray(wrf_array, lat, lon, hgt, parameters)
+            with instrumentation.stage('mask'):
+                wrf_array_masked = execution.timeChunked(addStepPrecipitation(geoMaskWrfArray(wrf_array_formatted, args.geojson)), args.timeChunk)
+                if args.derived:
+                    wrf_array_masked = derived.derive(wrf_array_masked, 'wrf')
+                wrf_array_masked, encoding = packing.prepare(wrf_array_masked, packing.specFromArgs('wrf', args), args.cellLayout)
+
+            # Write to zarr and cleanup
+            with scheduling.storeLock(storePath(args.outputDir, store)), instrumentation.stage('write', scheduler=args.scheduler):
+                write_to_zarr(wrf_array_masked, args.outputDir, store, encoding)
+        with instrumentation.stage('cleanup'):
+            cleanUpFiles(downloaded_files)
+            cleanUpFiles([md_file])
 
 if __name__ == "__main__":
     # Get Arguments - model, variables, product, date range, and geo_json
-    args = setupArgs()
-    parameters = parseParameters(args.parameters)
-    files_to_download = generateFileNames(args.startDate, args.endDate, args.model, args.dataTier, args.domain, args.historical, args.biasCorrected)
-
-    # Download 24 hrs at a time
-    start_time = dt.now()
-    with ThreadPoolExecutor(24) as executor:
-        downloaded_files = list(executor.map(lambda file: downloadS3File(BUCKET_NAME, file, args.outputDir), files_to_download))
-    end_time = dt.now()
-
-    failed_files = [f for f in downloaded_files if f is None]
-    downloaded_files = [f for f in downloaded_files if f is not None]
-    print('Time to download {} files: {} seconds'.format(len(downloaded_files), (end_time - start_time).seconds))
-    print(f'{len(failed_files)} failed to download')
-
-    if len(downloaded_files) == 0:
-        print('No files downloaded. Exiting...')
-        exit(0)
-
-    # Get Metadata File for Lat, Lon
-    md_file = downloadMetadataFile(args.domain, args.outputDir)
-    lat, lon, hgt = getLatLonHgtFromMetadata(md_file)
-
-    # Format, then geo limit by masking
-    wrf_array = xr.open_mfdataset(downloaded_files, combine='nested', concat_dim='Time')
-    wrf_array_formatted = formatWrfArray(wrf_array, lat, lon, hgt, parameters)
-    wrf_array_masked = geoMaskWrfArray(wrf_array_formatted, args.geojson)
-
-    # Write to zarr and cleanup
-    write_to_zarr(wrf_array_masked, args.outputDir, args.startDate + '_' + args.endDate + '_wrf_' + args.model + '_data.zarr')
-    cleanUpFiles(downloaded_files)
-    cleanUpFiles([md_file])
\ No newline at end of file
+    main(setupArgs())